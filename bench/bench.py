@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+'''
+Benchmarks for pysh, compared against plain `subprocess` and Bash.
+
+Usage:
+  python bench/bench.py [--quick] [--json FILE] [CASE...]
+
+Each case runs in a fresh Python process, so that its peak RSS is its
+own.  Results go to stdout as a table, and with --json also to FILE,
+as JSON with stable formatting so that results from two commits can
+be compared with `diff`.
+'''
+
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(THIS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+
+def peak_rss_kib(who=resource.RUSAGE_SELF) -> int:
+    rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in KiB on Linux, but bytes on macOS.
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def best_rate(func, number: int, repeat: int) -> float:
+    '''Calls per second of `func`, taking the best of `repeat` runs.'''
+    times = timeit.repeat(func, number=number, repeat=repeat)
+    return number / min(times)
+
+
+def bash_time(script: str, repeat: int, *args) -> float:
+    '''Median wall time of running `script` under Bash.'''
+    # No peak RSS for Bash: a child forked from us starts out with our
+    # own RSS, and RUSAGE_CHILDREN would count that.
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call(['bash', '-c', script, 'bash', *args],
+                              stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+#
+# The cases.  Each takes the `quick` flag, and returns a dict of results.
+#
+
+def case_shwords(quick):
+    from pysh import shwords, shwords_f
+    number = 20000 if quick else 200000
+    repeat = 3 if quick else 5
+    files = ['a.c', 'b c.c', 'd.c']
+    outdir = '/tmp/out dir'
+
+    def call_f(files=files, outdir=outdir):
+        # shwords_f sees the caller's locals, so it needs a real frame.
+        return shwords_f('cc -o {outdir}/a.out {files!@}')
+
+    return dict(
+        simple_per_sec=best_rate(
+            lambda: shwords('git rev-parse --show-toplevel'), number, repeat),
+        fields_per_sec=best_rate(
+            lambda: shwords('cc -c {} -o {outdir}/{}.o {!@}',
+                            'x.c', 'x', files, outdir=outdir),
+            number, repeat),
+        f_per_sec=best_rate(call_f, number, repeat),
+    )
+
+
+def case_spawn(quick):
+    import pysh
+    from pysh import spawn
+    number = 100 if quick else 1000
+    repeat = 3
+    raw_check = best_rate(
+        lambda: subprocess.check_call(['true']), number, repeat)
+    pysh_check = best_rate(lambda: pysh.check_cmd('true'), number, repeat)
+    raw_slurp = best_rate(
+        lambda: subprocess.check_output(['echo', 'hi']), number, repeat)
+    pysh_slurp = best_rate(
+        lambda: pysh.slurp_cmd('echo {}', 'hi'), number, repeat)
+    # Not plain `true`, which is a Bash builtin and starts no process.
+    bash_seconds = bash_time(
+        'for ((i = 0; i < $1; i++)); do /bin/true; done',
+        repeat, str(number))
+    return dict(
+        subprocess_check_call_us=1e6 / raw_check,
+        check_cmd_us=1e6 / pysh_check,
+        check_cmd_overhead_us=1e6 / pysh_check - 1e6 / raw_check,
+        subprocess_check_output_us=1e6 / raw_slurp,
+        slurp_cmd_us=1e6 / pysh_slurp,
+        slurp_cmd_overhead_us=1e6 / pysh_slurp - 1e6 / raw_slurp,
+        bash_spawn_us=1e6 * bash_seconds / number,
+        # The share of pysh's launches that took the posix_spawn path.
+        posix_spawn_fraction=spawn.counts['posix_spawn'] / sum(
+            spawn.counts.values()),
+        peak_rss_kib=peak_rss_kib(),
+    )
+
+
+def case_import(quick):
+    repeat = 10 if quick else 50
+
+    def startup(code):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.check_call([sys.executable, '-c', code],
+                                  cwd=REPO_DIR)
+            times.append(time.perf_counter() - start)
+        return statistics.median(times)
+
+    startup('import pysh')  # Compile bytecode, if it'll be cached.
+    bare = startup('pass')
+    return dict(
+        python_startup_ms=1e3 * bare,
+        import_pysh_ms=1e3 * (startup('import pysh') - bare),
+        import_shwords_ms=1e3 * (startup('from pysh import shwords') - bare),
+        import_cmd_ms=1e3 * (startup('from pysh import cmd') - bare),
+    )
+
+
+def make_data(path: str, size: int) -> None:
+    '''Write `size` bytes of deterministic, line-oriented data.'''
+    line_no = 0
+    written = 0
+    with open(path, 'wb') as f:
+        while written < size:
+            lines = b''.join(b'line %d of the benchmark input\n' % i
+                             for i in range(line_no, line_no + 1000))
+            line_no += 1000
+            f.write(lines)
+            written += len(lines)
+
+
+def case_pipeline(quick, size):
+    from pysh import cmd
+    repeat = 3
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'data')
+        make_data(path, size)
+        real_size = os.path.getsize(path)
+
+        rss_before = peak_rss_kib()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            count = 0
+            for _ in (cmd.cat(path) | cmd.run('cat') | cmd.splitlines()):
+                count += 1
+            times.append(time.perf_counter() - start)
+        seconds = statistics.median(times)
+
+        rss_after = peak_rss_kib()
+
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            (cmd.cat(path) | cmd.decode() | cmd.encode() | cmd.devnull())()
+            times.append(time.perf_counter() - start)
+        codec_seconds = statistics.median(times)
+
+        bash_seconds = bash_time('cat "$1" | cat | wc -l', repeat, path)
+
+    mb = real_size / 1e6
+    return dict(
+        bytes=real_size,
+        lines=count,
+        mb_per_sec=mb / seconds,
+        peak_rss_kib=rss_after,
+        # How much the pipeline added to our peak RSS: about constant,
+        # for a streaming pipeline, whatever the size of the data.
+        peak_rss_growth_kib=rss_after - rss_before,
+        bash_mb_per_sec=mb / bash_seconds,
+        # Decoding the same data to text, and encoding it back.
+        codec_mb_per_sec=mb / codec_seconds,
+    )
+
+
+PIPELINE_SIZES = [1 << 20, 16 << 20, 128 << 20]
+QUICK_PIPELINE_SIZES = [1 << 20, 8 << 20]
+
+
+def all_cases(quick):
+    cases = ['import', 'shwords', 'spawn']
+    sizes = QUICK_PIPELINE_SIZES if quick else PIPELINE_SIZES
+    cases.extend('pipeline_{}m'.format(size >> 20) for size in sizes)
+    return cases
+
+
+def run_case(name, quick):
+    if name.startswith('pipeline_'):
+        size = int(name[len('pipeline_'):-1]) << 20
+        return case_pipeline(quick, size)
+    return globals()['case_' + name](quick)
+
+
+def run_case_in_child(name, quick):
+    argv = [sys.executable, __file__, '--child', name]
+    if quick:
+        argv.append('--quick')
+    return json.loads(subprocess.check_output(argv))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('cases', nargs='*', metavar='CASE',
+                        help='cases to run (default: all)')
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer iterations and smaller data')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write results as JSON to FILE')
+    parser.add_argument('--child', metavar='CASE', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        json.dump(run_case(args.child, args.quick), sys.stdout)
+        return
+
+    results = {}
+    for name in args.cases or all_cases(args.quick):
+        results[name] = run_case_in_child(name, args.quick)
+        print(name)
+        for key, value in sorted(results[name].items()):
+            print('  {:30} {:>14.6g}'.format(key, value))
+
+    if args.json:
+        report = dict(
+            commit=git_commit(),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            quick=args.quick,
+            results=results,
+        )
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
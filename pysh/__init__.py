@@ -1,17 +1,68 @@
 
 # TODO better organize to reflect style `pysh.foo` vs `from pysh import foo`
 
-# Utilities for running external commands.
-from .words import shwords, shwords_f  # style: from pysh import shwords
-from .filters import slurp, to_stdout  # style: pysh.slurp, etc.
-from .subprocess import (  # style: from pysh import ...
-    check_cmd, check_cmd_f, slurp_cmd, slurp_cmd_f,
-    try_cmd, try_cmd_f, try_slurp_cmd, try_slurp_cmd_f,
-    # style: pysh.DEVNULL, etc.
-    DEVNULL, STDOUT,
-)
-
-# Decorators for "shell builtins".
-from .filters import filter, input, output, argument, option  # style: pysh....
+# Each name here is imported from its submodule only when first used
+# (PEP 562), so that e.g. `from pysh import shwords` doesn't load the
+# machinery for running commands.  Keep `import pysh` cheap: scripts
+# run it on every start.  See test/test_import.py.
+_exports = [
+    # Utilities for running external commands.
+    ('words', [  # style: from pysh import shwords
+        'shwords', 'shwords_f',
+        'compile_words',
+    ]),
+    ('filters', [  # style: pysh.slurp, etc.
+        'slurp', 'to_stdout', 'to_file', 'explain',
+    ]),
+    ('subprocess', [  # style: from pysh import ...
+        'check_cmd', 'check_cmd_f', 'slurp_cmd', 'slurp_cmd_f',
+        'try_cmd', 'try_cmd_f', 'try_slurp_cmd', 'try_slurp_cmd_f',
+        'map_cmd', 'try_map_cmd', 'check_map_cmd',
+        'cached', 'coproc',
+        # style: pysh.DEVNULL, etc.
+        'DEVNULL', 'STDOUT',
+    ]),
+
+    # The same, for use from asyncio coroutines.
+    ('asyncio', [  # style: pysh.aslurp, etc.
+        'aslurp', 'ato_stdout',
+        'acheck_cmd', 'aslurp_cmd', 'atry_cmd', 'atry_slurp_cmd',
+    ]),
+
+    # Decorators for "shell builtins".
+    ('filters', [  # style: pysh....
+        'filter', 'input', 'output', 'argument', 'option',
+    ]),
+]
 
 # No `from .cmd import ...`; instead, style: from pysh import cmd
+_submodules = ['cmd', 'deadline', 'launcher', 'spawn', 'trace']
+
+_origins = {name: module for module, names in _exports for name in names}
+
+__all__ = list(_origins) + _submodules
+
+
+def __getattr__(name):
+    import importlib
+    module = _origins.get(name)
+    if module is not None:
+        value = getattr(importlib.import_module('.' + module, __name__), name)
+    elif name in _submodules:
+        value = importlib.import_module('.' + name, __name__)
+    else:
+        raise AttributeError(
+            'module {!r} has no attribute {!r}'.format(__name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+# py36: module __getattr__ is new in Python 3.7; so just import it all now.
+import sys as _sys
+if _sys.version_info < (3, 7):
+    for _name in __all__:
+        __getattr__(_name)
@@ -0,0 +1,478 @@
+'''
+Running commands and pipelines on an :mod:`asyncio` event loop.
+
+These are counterparts of the functions in `pysh.subprocess` and of
+`.slurp()` and `.to_stdout()`, for use from coroutines: for example
+``await pysh.aslurp_cmd(...)`` in place of ``pysh.slurp_cmd(...)``.
+They're built on :func:`asyncio.create_subprocess_exec`, and never
+block the event loop.
+
+Pipelines are the same `Filter` objects as for `.slurp()` and the
+rest; the same pipeline can run either way.  An ``async for`` loop
+iterates through a pipeline producing an iterator, like `.cmd.splitlines`.
+
+Filters with an asyncio implementation, like `.cmd.run`, run directly
+on the event loop.  Any other filter, like a Python filter defined
+with `pysh.filter`, is ordinary blocking code; it runs in its own
+thread, connected to the rest of the pipeline by OS pipes.
+
+A few things work differently from the synchronous functions:
+
+* Commands are started by :mod:`asyncio` itself, not `.spawn.popen`.
+  So a running `.launcher` isn't used for them, and they aren't
+  counted in `.spawn.counts`.
+
+* Stages running natively on the event loop, like `.cmd.run`, are not
+  instrumented by `.trace`.  Stages running in threads are.
+
+* A *timeout*, as for `aslurp`, cancels the pipeline when it passes.
+  As under a `.deadline`, each command has a process group of its own,
+  so the processes it started are stopped too; but they get SIGKILL
+  at once, with no grace period after SIGTERM.  On Python 3.6, the
+  commands don't get process groups.
+
+* `aslurp` and `aslurp_cmd` have no option to spill output to a file.
+'''
+
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import threading
+from typing import Optional
+
+from . import cmd, deadline, spawn
+from .cmd import LineSplitter, check_delim, chunks, redirections
+from .filters import (
+    Filter, at_eof, broken_pipe, close_iterator, open_pipe, optimize)
+from .words import shwords
+
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # py36: contextvars is new in Python 3.7.
+    under_timeout = None
+else:
+    #: Whether the current task is running a pipeline under a *timeout*;
+    #: like `.deadline.new_group`.
+    under_timeout = ContextVar('under_timeout', default=False)
+
+
+def wait_readable(fd: int) -> asyncio.Future:
+    '''A future that completes when `fd` is readable.'''
+    # py36: asyncio.get_running_loop is new in Python 3.7.
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    loop.add_reader(fd, lambda: future.done() or future.set_result(None))
+    future.add_done_callback(lambda _: loop.remove_reader(fd))
+    return future
+
+
+async def achunks(f):
+    '''
+    Async generator for the contents of `f`, yielding once per underlying read.
+
+    Compare `.cmd.chunks`.  The file `f` should be one of our own pipe
+    ends, as it's put in non-blocking mode.
+    '''
+    fd = f.fileno()
+    os.set_blocking(fd, False)
+    while True:
+        try:
+            chunk = os.read(fd, 65536)
+        except BlockingIOError:
+            await wait_readable(fd)
+            continue
+        if not chunk:
+            return
+        yield chunk
+
+
+def run_in_thread(func, *args) -> asyncio.Future:
+    '''
+    Run `func(*args)` in a new thread, returning a future for the result.
+
+    Each call gets its own thread, rather than sharing an executor,
+    because stages of a pipeline block on each other; a bounded pool
+    could deadlock.
+    '''
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def resolve(exception, result):
+        if future.cancelled():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def target():
+        try:
+            result = func(*args)
+        except BaseException as e:
+            loop.call_soon_threadsafe(resolve, e, None)
+        else:
+            loop.call_soon_threadsafe(resolve, None, result)
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+
+def close_in_thread(f) -> None:
+    '''
+    Close `f` without blocking the event loop.
+
+    This is for a pipe end of a stage cut off early.  A stage running
+    in a thread, as by `run_in_thread`, may still be reading or writing
+    it, and holding its lock; then it's closed when that stage lets go.
+    '''
+    threading.Thread(target=f.close, daemon=True).start()
+
+
+class LeftStage:
+    '''
+    Async context manager running `left` into a pipe, giving the read end.
+
+    This is the asyncio counterpart of `.filters.StageThread`.
+    '''
+
+    def __init__(self, left: Filter, input) -> None:
+        self.left = left
+        self.input = input
+
+    async def __aenter__(self):
+        text = self.left.output.type == 'tstream'
+        self.reader, writer = open_pipe(text)
+        self.task = asyncio.ensure_future(self.run(writer))
+        return self.reader
+
+    async def run(self, writer) -> None:
+        try:
+            await run_thunk(self.left, self.input, writer)
+        except asyncio.CancelledError:
+            close_in_thread(writer)
+            raise
+        except BaseException:
+            writer.close()
+            raise
+        writer.close()
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        if exc_type is not None:
+            # The consumer failed, or stopped early, as when an ``async
+            # for`` loop is left and the iterator closed.  Cancel the
+            # left side, which kills its commands, but report the
+            # original error.
+            close_in_thread(self.reader)
+            self.task.cancel()
+            await asyncio.wait([self.task])
+            if not self.task.cancelled():
+                self.task.exception()
+            return
+        # As in `.filters.pipe_by_os_pipe`.
+        cut_off = not at_eof(self.reader)
+        self.reader.close()
+        try:
+            await self.task
+        except Exception as e:
+            # If the consumer stopped reading early, like `.cmd.head`,
+            # a broken pipe isn't a failure; as in `StageThread.finish`.
+            if not (cut_off and broken_pipe(e)):
+                raise
+
+
+def is_stream_pipe(filter: Filter) -> bool:
+    # Pipes carrying Python values, like 'iter' and 'bytes', are just
+    # function composition; a thread runs both sides together.
+    left, _ = filter.pipe
+    return left.output.type in ('stream', 'tstream')
+
+
+async def run_thunk(filter: Filter, input, output):
+    '''Run `filter`, like `filter.thunk(input, output)`, without blocking.'''
+    assert filter.output.type != 'iter'
+    if filter.pipe is not None and is_stream_pipe(filter):
+        left, right = filter.pipe
+        # As in `pipe_by_os_pipe`, skip the pipe if one side is a file.
+        source = left.source_file(input)
+        if source is not None:
+            with source:
+                return await run_thunk(right, source, output)
+        sink = right.sink_file(output)
+        if sink is not None:
+            with sink:
+                await run_thunk(left, input, sink)
+            return None
+        async with LeftStage(left, input) as reader:
+            return await run_thunk(right, reader, output)
+    function = filter.function
+    if function is not None and function.afunc is not None:
+        thunk = function.bind(function.afunc, filter.args, filter.kwargs)
+        return await thunk(input, output)
+    return await run_in_thread(filter.thunk, input, output)
+
+
+async def aiter_thunk(filter: Filter, input):
+    '''Iterate through `filter`'s output, like `filter.thunk(input, None)`.'''
+    assert filter.output.type == 'iter'
+    if filter.pipe is not None and is_stream_pipe(filter):
+        left, right = filter.pipe
+        source = left.source_file(input)
+        if source is not None:
+            with source:
+                async for item in aiter_thunk(right, source):
+                    yield item
+            return
+        async with LeftStage(left, input) as reader:
+            async for item in aiter_thunk(right, reader):
+                yield item
+        return
+
+    function = filter.function
+    if function is not None and function.afunc is not None:
+        thunk = function.bind(function.afunc, filter.args, filter.kwargs)
+        async for item in thunk(input, None):
+            yield item
+        return
+
+    async for item in iterate_in_thread(filter, input):
+        yield item
+
+
+async def iterate_in_thread(filter: Filter, input, buffered: int = 64):
+    '''Iterate through a blocking iterator filter, in its own thread.'''
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue()
+    # Bounds how far the thread can get ahead of the consumer.
+    slots = threading.Semaphore(buffered)
+    stop = threading.Event()
+
+    def target():
+        try:
+            iterator = filter.thunk(input, None)
+            try:
+                for item in iterator:
+                    slots.acquire()
+                    if stop.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, (True, item))
+            finally:
+                close_iterator(iterator)
+            result = (None, None)
+        except BaseException as e:
+            result = (False, e)
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, result)
+        except RuntimeError:
+            pass  # The event loop is closed; nobody is listening.
+
+    threading.Thread(target=target, daemon=True).start()
+    try:
+        while True:
+            ok, value = await queue.get()
+            if ok:
+                slots.release()
+                yield value
+            elif ok is None:
+                return
+            else:
+                raise value
+    finally:
+        stop.set()
+        slots.release()
+
+
+@cmd.run.asynchronous
+async def _run(input, output, fmt, *args, _check=True, _stderr=None):
+    # Compare `cmd.run`, which this mirrors.
+    cmd = shwords(fmt, *args)
+
+    stdin, stdout = redirections(input, output)
+
+    new_group = under_timeout is not None and under_timeout.get()
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=stdin,
+        stdout=stdout,
+        stderr=_stderr,
+        **spawn.group_options(new_group)
+    )
+    proc.new_group = new_group
+
+    async def feed():
+        try:
+            for chunk in chunks(input):
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The command stopped reading its input.
+        proc.stdin.close()
+
+    async def drain():
+        while True:
+            chunk = await proc.stdout.read(65536)
+            if not chunk:
+                return
+            output.write(chunk)
+
+    pumps = []
+    if stdin == subprocess.PIPE:
+        pumps.append(feed())
+    if stdout == subprocess.PIPE:
+        pumps.append(drain())
+    try:
+        await asyncio.gather(*pumps)
+        retcode = await proc.wait()
+    except BaseException:
+        # Including cancellation, as when the consumer stops early.
+        if proc.returncode is None:
+            deadline.signal_proc(proc, signal.SIGKILL)
+            await proc.wait()
+        raise
+
+    if _check and retcode:
+        raise subprocess.CalledProcessError(retcode, cmd)
+
+
+@cmd.splitlines.asynchronous
+async def _splitlines(input, delim=b'\n', views=False):
+    # With `views`, each line is simply a view on its own `bytes`.
+    check_delim(delim)
+    wrap = memoryview if views else (lambda line: line)
+    splitter = LineSplitter(delim)
+    async for chunk in achunks(input):
+        for line in splitter.feed(chunk):
+            yield wrap(line)
+    for line in splitter.finish():
+        yield wrap(line)
+
+
+async def run_with_timeout(coroutine, timeout: Optional[float], cmd):
+    '''
+    Await `coroutine`, within *timeout* seconds if not None.
+
+    Compare `.deadline.run`.  If the time runs out, the coroutine is
+    cancelled, which kills its commands, and this raises
+    :class:`subprocess.TimeoutExpired` for *cmd*.
+    '''
+    if timeout is None:
+        return await coroutine
+    token = None if under_timeout is None else under_timeout.set(True)
+    try:
+        return await asyncio.wait_for(coroutine, timeout)
+    except asyncio.TimeoutError:
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    finally:
+        if token is not None:
+            under_timeout.reset(token)
+
+
+async def aslurp(filter: Filter, *, timeout: Optional[float] = None) -> bytes:
+    '''
+    Just like `.slurp()`, but as a coroutine.
+    '''
+    if filter.input.required or filter.output.type != 'stream':
+        raise RuntimeError()
+
+    async def pipeline():
+        async with LeftStage(optimize(filter), None) as reader:
+            return b''.join([chunk async for chunk in achunks(reader)])
+    output = await run_with_timeout(pipeline(), timeout, filter)
+    return output.rstrip(b'\n')
+
+
+async def ato_stdout(filter: Filter, *,
+                     timeout: Optional[float] = None) -> None:
+    '''
+    Just like `.to_stdout()`, but as a coroutine.
+    '''
+    if filter.input.required:
+        raise RuntimeError()
+    if filter.output.type in ('none', 'iter', 'bytes'):
+        raise RuntimeError()
+    assert filter.output.type in ('stream', 'tstream')
+    sys.stdout.flush()
+    output = sys.stdout.buffer if filter.output.type == 'stream' else sys.stdout
+    await run_with_timeout(run_thunk(optimize(filter), None, output),
+                           timeout, filter)
+
+
+async def wait_cmd(proc, cmd, timeout, input=None):
+    '''Like `Popen.communicate`, with a `TimeoutExpired` as in `subprocess`.'''
+    try:
+        output, _ = await asyncio.wait_for(proc.communicate(input), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+        raise
+    return output
+
+
+async def acheck_cmd(fmt, *args,
+                     _stdin=None, _stdout=None, _stderr=None,
+                     _cwd=None, _timeout=None,
+                     **kwargs) -> None:
+    '''
+    Just like `.check_cmd()`, but as a coroutine.
+    '''
+    cmd = shwords(fmt, *args, **kwargs)
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=_stdin,
+        stdout=_stdout,
+        stderr=_stderr,
+        cwd=_cwd,
+    )
+    await wait_cmd(proc, cmd, _timeout)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+async def atry_cmd(fmt, *args, **kwargs) -> bool:
+    '''
+    Just like `.try_cmd()`, but as a coroutine.
+    '''
+    try:
+        await acheck_cmd(fmt, *args, **kwargs)
+    except subprocess.CalledProcessError:
+        return False
+    return True
+
+
+async def aslurp_cmd(fmt, *args,
+                     _stdin=None, _stderr=None,
+                     _cwd=None, _timeout=None,
+                     **kwargs) -> bytes:
+    '''
+    Just like `.slurp_cmd()`, but as a coroutine.
+    '''
+    cmd = shwords(fmt, *args, **kwargs)
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=_stdin,
+        stdout=subprocess.PIPE,
+        stderr=_stderr,
+        cwd=_cwd,
+    )
+    raw_output = await wait_cmd(proc, cmd, _timeout)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(
+            proc.returncode, cmd, output=raw_output)
+    return raw_output.rstrip(b'\n')
+
+
+async def atry_slurp_cmd(fmt, *args, **kwargs) -> Optional[bytes]:
+    '''
+    Just like `.try_slurp_cmd()`, but as a coroutine.
+    '''
+    try:
+        return await aslurp_cmd(fmt, *args, **kwargs)
+    except subprocess.CalledProcessError:
+        return None
@@ -5,9 +5,17 @@ Usage:
 '''
 
 import codecs
+import functools
 import io
+import os
+import queue
+import selectors
 import subprocess
+import threading
+from typing import List, Optional
 
+from pysh import deadline, spawn, trace
+from pysh.filters import Filter, open_pipe, optimize
 from pysh.words import shwords
 
 
@@ -51,6 +59,10 @@ def devnull(input, output):
       pipeline ``cmd.devnull() | …``;
     * a shell command like ``… >/dev/null`` corresponds to a Pysh
       pipeline ``… | cmd.devnull()``.
+
+    Next to an external command in a pipeline, this is implemented
+    just like those shell redirections: the command gets ``/dev/null``
+    itself as its stdin or stdout.
     '''
     if output is not None:
         output.close()
@@ -60,6 +72,23 @@ def devnull(input, output):
             pass
 
 
+# In a pipeline next to another stage, such as an external command,
+# `devnull` is simply the file /dev/null.
+
+@devnull.as_source
+def _devnull_source(input):
+    if input is not None:
+        return None  # We'd need to drain it.
+    return open(os.devnull, 'rb')
+
+
+@devnull.as_sink
+def _devnull_sink(output):
+    if output is not None:
+        output.close()
+    return open(os.devnull, 'wb')
+
+
 @pysh.filter
 # input none
 @pysh.output(type='stream')
@@ -100,35 +129,266 @@ def cat(output, *filenames):
     * The filename ``-``, or an empty list of filenames, are not
       special; instead of reading from stdin, they cause reading from
       a file named ``-``, and an empty output, respectively.
+
+    When the output is backed by a file descriptor, as when it's
+    piped to `run` or to `.to_stdout()`, the files are copied to it
+    within the kernel, with :func:`os.sendfile`.  And at the start of
+    a pipeline, ``cat`` of just one file is simply that file: the next
+    stage reads it directly, so `run` gets it as stdin.
     '''
     for filename in filenames:
         with open(filename, 'rb') as f:
-            for chunk in chunks(f):
-                output.write(chunk)
+            copy_file(f, output)
+
+
+# In a pipeline, `cat` of one file is simply that file; so an external
+# command after it gets the file itself as stdin, like ``<file``.
+
+@cat.as_source
+def _cat_source(input, *filenames):
+    if len(filenames) != 1:
+        return None
+    return open(filenames[0], 'rb')
+
+
+@pysh.filter
+# input none
+@pysh.output(type='stream')
+@pysh.argument(type='filename')
+def read_file(output, path):
+    '''
+    Output the contents of the file *path*.
+
+    This corresponds to the shell redirection ``<path``: in a
+    pipeline, the next stage reads the file directly, so an external
+    command gets it as its stdin, and its contents never pass through
+    Python.
+    '''
+    with open(path, 'rb') as f:
+        copy_file(f, output)
+
+
+@read_file.as_source
+def _read_file_source(input, path):
+    return open(path, 'rb')
 
 
 @pysh.filter
 @pysh.input(type='stream')
-@pysh.output(type='tstream')
-def decode(input, output):
-    # TODO tests
-    for chunk in codecs.iterdecode(chunks(input), 'utf-8'):
+# output none
+@pysh.argument(type='filename')
+@pysh.option('--append', type=bool)
+def write_file(input, path, append=False):
+    '''
+    Write the input to the file *path*, replacing it; or if *append*
+    is true, adding to the end.
+
+    This corresponds to the shell redirection ``>path``, or with
+    *append*, ``>>path``: in a pipeline, the previous stage writes to
+    the file directly, so an external command gets it as its stdout.
+    For example:
+
+    >>> ( cmd.run('sort') | cmd.write_file('sorted.txt') )()
+
+    See also `.to_file()`.
+    '''
+    with open(path, 'ab' if append else 'wb') as f:
+        copy_file(input, f)
+
+
+@write_file.as_sink
+def _write_file_sink(output, path, append=False):
+    return open(path, 'ab' if append else 'wb')
+
+
+def copy_file(f: io.BufferedReader, output) -> None:
+    '''
+    Copy the contents of `f` to `output`.
+
+    When both have file descriptors, and the OS supports it, the copy
+    is done with :func:`os.sendfile` so that the data never comes into
+    userspace.  Otherwise, the data is copied a chunk at a time.
+    '''
+    if has_fileno(f) and has_fileno(output) and hasattr(os, 'sendfile'):
+        output.flush()
+        infd, outfd = f.fileno(), output.fileno()
+        offset = 0
+        try:
+            while True:
+                sent = os.sendfile(outfd, infd, offset, 1 << 30)
+                if not sent:
+                    return
+                offset += sent
+        except BrokenPipeError:
+            raise
+        except OSError:
+            # Perhaps sendfile doesn't work for this input or output,
+            # like a terminal for output on Linux, or anything but a
+            # socket on macOS.  Fall back if we can.
+            if offset:
+                raise
+    for chunk in chunks(f):
         output.write(chunk)
 
 
+@pysh.filter
+@pysh.input(type='stream')
+@pysh.output(type='tstream')
+@pysh.option('--encoding', type=str)
+@pysh.option('--errors', type=str)
+def decode(input, output, encoding='utf-8', errors='strict'):
+    '''
+    Decode the input bytes as text, in the given *encoding*.
+
+    The *encoding* and *errors* have the same meaning as for
+    :meth:`bytes.decode`.  For example, to pass along invalid UTF-8
+    rather than fail:
+
+    >>> pysh.to_stdout( cmd.cat('data') | cmd.decode(errors='replace')
+    ...                 | cmd.encode() )
+
+    The input is decoded a large block at a time, as it arrives, with
+    a fast path for runs of ASCII.
+    '''
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    # Python's own decoders for these already have an ASCII fast path,
+    # faster than checking for ASCII ourselves.
+    fast = (ascii_compatible(encoding)
+            and codecs.lookup(encoding).name not in NATIVE_ASCII_CODECS)
+    for block in blocks(input):
+        if fast and isascii(block) and not decoder.getstate()[0]:
+            output.write(block.decode('ascii'))
+        else:
+            output.write(decoder.decode(block))
+    output.write(decoder.decode(b'', final=True))
+
+
 @pysh.filter
 @pysh.input(type='tstream')
 @pysh.output(type='stream')
-def encode(input, output):
-    # TODO tests
-    for chunk in codecs.iterencode(chunks_text(input), 'utf-8'):
-        output.write(chunk)
+@pysh.option('--encoding', type=str)
+@pysh.option('--errors', type=str)
+def encode(input, output, encoding='utf-8', errors='strict'):
+    '''
+    Encode the input text as bytes, in the given *encoding*.
+
+    The *encoding* and *errors* have the same meaning as for
+    :meth:`str.encode`.  This is the inverse of `decode`.
+
+    The text is encoded a large block at a time, as it arrives, with a
+    fast path for runs of ASCII.
+    '''
+    encoder = codecs.getincrementalencoder(encoding)(errors)
+    if not isinstance(input, io.TextIOWrapper):
+        for text in chunks_text(input):
+            output.write(encoder.encode(text))
+        output.write(encoder.encode('', final=True))
+        return
+
+    # Take the input's underlying bytes, a block at a time; text streams
+    # lack `read1`, and their `read` waits to fill the requested size.
+    # When those bytes are ASCII, they're the same in our encoding too.
+    # (Our input is normally a fresh pipe from the previous stage, so
+    # the text stream has nothing of its own buffered.)
+    decoder = codecs.getincrementaldecoder(input.encoding)(input.errors)
+    fast = ascii_compatible(input.encoding) and ascii_compatible(encoding)
+    for block in blocks(input.buffer):
+        if fast and isascii(block) and not decoder.getstate()[0]:
+            output.write(block)
+        else:
+            output.write(encoder.encode(decoder.decode(block)))
+    output.write(encoder.encode(decoder.decode(b'', final=True), final=True))
+
+
+# In a pipeline, a `decode` and `encode` that exactly undo each other
+# are dropped.  That's for bytes to text and back with any errors
+# handling for Latin-1, which maps each byte to a character, or with
+# "surrogateescape" for UTF-8 and ASCII; or text to bytes and back
+# with "surrogatepass" for UTF-8.
+
+def codec_args(encoding='utf-8', errors='strict'):
+    '''The arguments of `decode` or `encode`, normalized.'''
+    return codecs.lookup(encoding).name, errors
+
+
+def inverse_codecs(first, args, kwargs, second: Filter) -> bool:
+    '''Whether `first(*args, **kwargs)` is undone by `second`.'''
+    if (first, second.function) not in ((decode, encode), (encode, decode)):
+        return False
+    try:
+        encoding, errors = codec_args(*args, **kwargs)
+        if codec_args(*second.args, **second.kwargs) != (encoding, errors):
+            return False
+    except LookupError:
+        return False  # Let it fail as usual, when run.
+    if first is decode:
+        return (encoding == 'iso8859-1'
+                or (encoding in ('utf-8', 'ascii')
+                    and errors == 'surrogateescape'))
+    return encoding == 'utf-8' and errors == 'surrogatepass'
+
+
+@decode.as_rewrite
+def _decode_rewrite(following, *args, **kwargs):
+    return [] if inverse_codecs(decode, args, kwargs, following) else None
+
+
+@encode.as_rewrite
+def _encode_rewrite(following, *args, **kwargs):
+    return [] if inverse_codecs(encode, args, kwargs, following) else None
+
+
+def blocks(f: io.BufferedReader, size: int = 1 << 16):
+    '''Like `chunks`, but in blocks of up to `size`, for bulk processing.'''
+    block = f.read1(size)
+    while block:
+        yield block
+        block = f.read1(size)
+
+
+NATIVE_ASCII_CODECS = {'utf-8', 'ascii', 'iso8859-1'}
+
+# py36: bytes.isascii is new in Python 3.7.
+isascii = getattr(bytes, 'isascii', lambda block: False)
+
+
+# Codecs that are stateless, and represent ASCII text just as ASCII
+# does; so a run of ASCII bytes always means the same text.  Not so
+# for stateful codecs like ISO-2022-JP or UTF-7, which use only 7-bit
+# bytes, with escape sequences to switch between character sets.
+STATELESS_ASCII_CODECS = frozenset(
+    ['utf-8', 'ascii', 'koi8-r', 'koi8-u', 'mac-roman',
+     'cp437', 'cp850', 'cp866', 'cp874', 'cp932', 'cp949', 'cp950',
+     'shift_jis', 'euc_jp', 'euc_jis_2004', 'euc_jisx0213', 'euc_kr',
+     'johab', 'gb2312', 'gbk', 'gb18030', 'big5', 'big5hkscs']
+    + ['iso8859-{}'.format(n) for n in range(1, 17) if n != 12]
+    + ['cp125{}'.format(n) for n in range(9)])
+
+
+@functools.lru_cache()
+def ascii_compatible(encoding: str) -> bool:
+    '''Whether ASCII bytes in `encoding` are always just ASCII text.'''
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        return False
+    if name not in STATELESS_ASCII_CODECS:
+        return False
+    # Check anyway, in case this Python's tables differ.
+    ascii = bytes(range(128))
+    try:
+        return (ascii.decode(encoding) == ascii.decode('ascii')
+                and ascii.decode('ascii').encode(encoding) == ascii)
+    except UnicodeError:
+        return False
 
 
 @pysh.filter
 @pysh.input(type='stream')
 @pysh.output(type='iter')
-def splitlines(input):
+@pysh.option('-d', type=bytes)
+@pysh.option('--views', type=bool)
+def splitlines(input, delim=b'\n', views=False):
     '''
     Split the input stream into an iterator of lines.
 
@@ -141,23 +401,290 @@ def splitlines(input):
     This is also the same behavior as Python's :meth:`bytes.splitlines`,
     except that only ``b'\\n'`` counts as a newline: ``b'\\r'`` is
     treated the same as any other byte.
+
+    With *delim*, a different single byte terminates lines instead of
+    newline.  For example, ``delim=b'\\0'`` splits the output of
+    ``find -print0``.
+
+    If *views* is true, each line is a :class:`memoryview` into a
+    buffer that's reused for the following lines, rather than a fresh
+    `bytes`.  This saves copying and allocation when lines are long,
+    but each line is only valid until the next one is requested; take
+    ``bytes(line)`` to keep it longer.  When lines are short, the
+    default is faster.
     '''
-    # Future feature: options like delim=b'\0'
-    delimiter = b'\n'
-    fragment = b''
+    check_delim(delim)
+    if views:
+        yield from split_into_views(input, delim)
+        return
+    splitter = LineSplitter(delim)
     for chunk in chunks(input):
+        yield from splitter.feed(chunk)
+    yield from splitter.finish()
+
+
+def check_delim(delim: bytes) -> None:
+    if not isinstance(delim, bytes) or len(delim) != 1:
+        raise ValueError('delimiter must be a single byte: {!r}'.format(delim))
+
+
+class LineSplitter:
+    '''Incrementally split a stream of chunks into lines; see `splitlines`.'''
+
+    def __init__(self, delimiter: bytes) -> None:
+        self.delimiter = delimiter
+        # The pieces of a line begun in earlier chunks.  Kept as a list,
+        # and joined only once the line is complete, so that a long line
+        # spanning many chunks takes time linear in its length.
+        self.fragments = []  # type: List[bytes]
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        '''Consume `chunk`, and return the lines it completes.'''
         assert chunk
-        pieces = chunk.split(delimiter)
+        pieces = chunk.split(self.delimiter)
         assert pieces
-        # There are `len(pieces) - 1` newlines in `chunk`.
+        # There are `len(pieces) - 1` delimiters in `chunk`.
         if len(pieces) == 1:
-            fragment += pieces[0]
+            self.fragments.append(chunk)
+            return []
+        if self.fragments:
+            self.fragments.append(pieces[0])
+            pieces[0] = b''.join(self.fragments)
+            self.fragments.clear()
+        last = pieces.pop()
+        if last:
+            self.fragments.append(last)
+        return pieces
+
+    def finish(self) -> List[bytes]:
+        '''Return the last line, if the input didn't end with a delimiter.'''
+        return [b''.join(self.fragments)] if self.fragments else []
+
+
+def split_into_views(input: io.BufferedReader, delim: bytes,
+                     size: int = 65536):
+    # The implementation of `splitlines(views=True)`.
+    buf = bytearray(size)
+    view = memoryview(buf)
+    filled = 0  # The start of `buf` holds this much of an unfinished line.
+    while True:
+        if filled == len(buf):
+            # A line longer than the buffer.  Replace the buffer with a
+            # bigger one, rather than resize it, because the consumer
+            # may be holding views into it.
+            buf = bytearray(2 * len(buf))
+            buf[:filled] = view
+            view = memoryview(buf)
+        count = input.readinto1(view[filled:])
+        if not count:
+            break
+        end = filled + count
+        start = 0
+        find = buf.find
+        pos = find(delim, filled, end)
+        while pos >= 0:
+            yield view[start:pos]
+            start = pos + 1
+            pos = find(delim, start, end)
+        # Move the unfinished line to the front.  This writes over
+        # lines already yielded, but doesn't resize the buffer.
+        filled = end - start
+        buf[:filled] = buf[start:end]
+    if filled:
+        yield view[:filled]
+
+
+@pysh.filter
+@pysh.input(type='iter')
+@pysh.output(type='stream')
+@pysh.option('-d', type=bytes)
+def joinlines(input, output, delim=b'\n'):
+    '''
+    Write each item of the input iterator as a line.
+
+    This is the inverse of `splitlines`: each item, which should be
+    `bytes`, is written followed by a newline byte ``b'\\n'``, or by
+    *delim* if given.
+
+    For example:
+
+    >>> pysh.to_stdout( cmd.echo(b'b\\na') | cmd.splitlines()
+    ...                 | cmd.joinlines() | cmd.run('sort') )
+    a
+    b
+    '''
+    for line in input:
+        output.write(line)
+        output.write(delim)
+
+
+@pysh.filter
+@pysh.input(type='stream')
+@pysh.output(type='stream')
+@pysh.option('-n', type=int)
+def head(input, output, n=10):
+    '''
+    Copy the first *n* lines of the input to the output, then stop.
+
+    This corresponds to the Unix command ``head -n``.  Like that
+    command, it stops reading once it has its lines, so the stages
+    before it get a broken pipe and stop too, rather than running to
+    completion:
+
+    >>> pysh.slurp( cmd.run('yes') | cmd.head(3) )
+    b'y\ny\ny'
+    '''
+    for _ in range(n):
+        line = input.readline()
+        if not line:
+            break
+        output.write(line)
+
+
+@pysh.filter
+@pysh.input(type='stream')
+@pysh.output(type='stream', required=False)
+@pysh.argument(n='*')
+def tee(input, output, *sinks):
+    '''
+    Copy the input to each of the given *sinks*, and to the output.
+
+    Each of the *sinks* may be:
+
+    * a filename, for a file to create or overwrite;
+    * a binary file object, to write to;
+    * a callable, to call with each chunk of the input as a `bytes`,
+      like the ``update`` method of a :mod:`hashlib` hash;
+    * a pipeline, taking a byte stream as input, to run with this
+      input.  Its output, if any, is discarded.
+
+    For example, to compress a file while computing its checksum:
+
+    >>> digest = hashlib.sha256()
+    >>> pysh.to_stdout( cmd.cat('data') | cmd.tee(digest.update)
+    ...                 | cmd.run('gzip') )
+
+    This corresponds to the Unix command ``tee``.
+
+    The sinks all consume the input concurrently, each in its own
+    thread, and at their own pace up to a few chunks apart; then the
+    fastest wait for the slowest.  So memory use stays bounded however
+    long the input, and one slow sink doesn't stall the others sooner
+    than it must.
+
+    If a sink stops reading, as with a pipeline like ``cmd.run('head')``,
+    the others carry on.  If a sink fails, the others carry on too;
+    then the exception is raised at the end.
+    '''
+    branches = []
+    try:
+        # If a sink fails to start, still finish those started before it.
+        for sink in sinks:
+            branches.append(TeeBranch(sink))
+        for chunk in chunks(input):
+            if output is not None:
+                output.write(chunk)
+            for branch in branches:
+                branch.queue.put(chunk)
+    finally:
+        for branch in branches:
+            branch.queue.put(None)
+        for branch in branches:
+            branch.join()
+    for branch in branches:
+        if branch.exception is not None:
+            raise branch.exception
+
+
+class TeeBranch(threading.Thread):
+    '''Feeds the chunks put in `queue` to one sink of `tee`, until a None.'''
+
+    # How many chunks can wait for the sink, before `tee` waits for it.
+    BUFFERED = 16
+
+    def __init__(self, sink) -> None:
+        super().__init__(daemon=True)
+        self.queue = queue.Queue(self.BUFFERED)  # type: queue.Queue
+        self.exception = None  # type: Optional[BaseException]
+        self.pipeline = None  # type: Optional[threading.Thread]
+        if isinstance(sink, Filter):
+            if sink.input.type != 'stream':
+                raise ValueError(
+                    'tee sink must take a byte stream: {!r}'.format(sink))
+            reader, self.file = open_pipe(text=False)
+            self.pipeline = threading.Thread(
+                target=deadline.inherit(self.run_pipeline),
+                args=(sink, reader), daemon=True)
+            self.pipeline_exception = None
+            self.pipeline.start()
+            self.write = self.file.write
+            self.owned = True
+        elif isinstance(sink, (str, bytes, os.PathLike)):
+            self.file = open(sink, 'wb')
+            self.write = self.file.write
+            self.owned = True
+        elif callable(sink):
+            self.file = None
+            self.write = sink
+            self.owned = False
         else:
-            yield fragment + pieces[0]
-            yield from pieces[1:-1]
-            fragment = pieces[-1]
-    if fragment:
-        yield fragment
+            self.file = sink
+            self.write = sink.write
+            self.owned = False
+        self.start()
+
+    def run(self) -> None:
+        # Drain the queue no matter what, so `tee` never waits on us.
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if self.exception is None:
+                try:
+                    self.write(chunk)
+                except BaseException as e:
+                    self.exception = e
+        try:
+            self.finish()
+        except BaseException as e:
+            # A pipeline's failure may be why it stopped reading.
+            if self.exception is None or isinstance(
+                    self.exception, BrokenPipeError):
+                self.exception = e
+        if isinstance(self.exception, BrokenPipeError):
+            # The sink stopped reading; that's its business.
+            self.exception = None
+
+    def finish(self) -> None:
+        try:
+            if self.owned:
+                self.file.close()
+            elif self.file is not None:
+                self.file.flush()
+        finally:
+            if self.pipeline is not None:
+                self.pipeline.join()
+                if self.pipeline_exception is not None:
+                    raise self.pipeline_exception
+
+    def run_pipeline(self, filter: Filter, input) -> None:
+        # Run `filter` with `input`, discarding any output.  Planned like
+        # any other pipeline, so its source, sink, and rewrite hooks apply.
+        filter = optimize(filter)
+        try:
+            with input:
+                output_type = filter.output.type
+                if output_type in ('stream', 'tstream'):
+                    mode = 'wb' if output_type == 'stream' else 'w'
+                    with open(os.devnull, mode) as output:
+                        filter.thunk(input, output)
+                elif output_type == 'iter':
+                    for _ in filter.thunk(input, None):
+                        pass
+                else:
+                    filter.thunk(input, None)
+        except BaseException as e:
+            self.pipeline_exception = e
 
 
 def has_fileno(f: io.IOBase) -> bool:
@@ -168,6 +695,75 @@ def has_fileno(f: io.IOBase) -> bool:
         return False
 
 
+def pump(proc: subprocess.Popen, input, output) -> None:
+    '''
+    Feed `input` to `proc.stdin`, while copying `proc.stdout` to `output`.
+
+    Either of `proc.stdin` and `proc.stdout` may be None, and then the
+    corresponding side is skipped.  The two directions are interleaved,
+    so that neither side needs more than one chunk buffered at a time.
+    '''
+    # Compare Popen._communicate, in cpython:Lib/subprocess.py; but
+    # that reads the whole output into memory, and takes the whole
+    # input as a single `bytes`.
+    with selectors.DefaultSelector() as selector:
+        if proc.stdin is not None:
+            infd = proc.stdin.fileno()
+            os.set_blocking(infd, False)
+            selector.register(infd, selectors.EVENT_WRITE)
+            input_chunks = chunks(input)
+            pending = memoryview(b'')
+        if proc.stdout is not None:
+            outfd = proc.stdout.fileno()
+            selector.register(outfd, selectors.EVENT_READ)
+
+        while selector.get_map():
+            for key, _ in selector.select():
+                if proc.stdout is not None and key.fd == outfd:
+                    chunk = os.read(outfd, 65536)
+                    if chunk:
+                        output.write(chunk)
+                    else:
+                        selector.unregister(outfd)
+                        proc.stdout.close()
+                    continue
+
+                if not pending:
+                    chunk = next(input_chunks, None)
+                    if chunk is None:
+                        selector.unregister(infd)
+                        proc.stdin.close()
+                        continue
+                    pending = memoryview(chunk)
+                try:
+                    pending = pending[os.write(infd, pending):]
+                except BlockingIOError:
+                    pass
+                except BrokenPipeError:
+                    # The command stopped reading its input.  That's its
+                    # business; we just stop writing.
+                    selector.unregister(infd)
+                    proc.stdin.close()
+
+
+def redirections(input, output):
+    '''
+    The stdin and stdout for a command run as a stage, as by `run`.
+
+    An end backed by a file descriptor is passed as is; any other gets
+    `subprocess.PIPE`, for the caller to pump.
+    '''
+    stdin = (subprocess.DEVNULL if input is None
+             else input if has_fileno(input)
+             else subprocess.PIPE)
+    stdout = (output if has_fileno(output)
+              else subprocess.PIPE)
+    if stdout is output:
+        # Anything already written must come before the command's output.
+        output.flush()
+    return stdin, stdout
+
+
 @pysh.filter
 @pysh.input(type='stream', required=False)
 @pysh.output(type='stream')
@@ -184,7 +780,7 @@ def run(input, output, fmt, *args, _check=True, _stderr=None):
     * The given *fmt* and *\*args* are interpreted by `.shwords()` to
       produce a command line.
 
-    * The command line is executed (using :class:`subprocess.Popen`),
+    * The command line is executed (using `.spawn.popen`),
       with stdin and stdout connected to the filter's input and output
       in the pipeline.  Input is optional.
 
@@ -195,11 +791,20 @@ def run(input, output, fmt, *args, _check=True, _stderr=None):
       failure just like `.check_cmd()`.  Otherwise, the
       external command's return code is ignored.
 
-    **NOTE**: In the current implementation, the input may be read
-    completely into a buffer before any of it is passed to the
-    external command.  This is just fine for lots of scripts, but will
-    be fixed before Pysh 1.0.  If you have a use case where this
-    matters, please file an issue, to help prioritize fixing it.
+      If the command is killed by SIGPIPE because the next stage
+      stopped reading early, as `head` does, that isn't a failure of
+      the pipeline; just as for a Python stage's :class:`BrokenPipeError`.
+
+    When the input or output is backed by a file descriptor, the
+    external command gets that file descriptor directly.  In
+    particular, between two adjacent ``cmd.run`` stages in a pipeline
+    the data flows through an OS pipe from one command to the next,
+    just as in a shell, and never passes through Python.
+
+    When the input or output isn't backed by a file descriptor, the
+    data is passed between it and the external command a chunk at a
+    time, interleaving the two directions; so neither is ever buffered
+    in full.
     '''
 
     cmd = shwords(fmt, *args)
@@ -207,38 +812,23 @@ def run(input, output, fmt, *args, _check=True, _stderr=None):
     assert input is None or isinstance(input, io.IOBase)
     assert isinstance(output, io.IOBase)
 
-    stdin = (subprocess.DEVNULL if input is None
-             else input if has_fileno(input)
-             else subprocess.PIPE)
-    stdout = (output if has_fileno(output)
-              else subprocess.PIPE)
+    stdin, stdout = redirections(input, output)
 
-    # Compare subprocess.run and Popen.communicate, in cpython:Lib/subprocess.py.
-    proc = subprocess.Popen(
+    # Compare subprocess.run, in cpython:Lib/subprocess.py.
+    with spawn.popen(
             cmd,
             stdin=stdin,
             stdout=stdout,
             stderr=_stderr,
-    )
-    if input is None:
-        # Simplify in the case where no interleaved I/O is necessary.
-        # This mirrors what Popen.communicate does, except with a `.read()`
-        # expanded to pipeline chunks.
-        if stdout == subprocess.PIPE:
-            for chunk in chunks(proc.stdout):
-                output.write(chunk)
-            proc.stdout.close()
-        proc.wait()
-    else:
-        # TODO this just exhausts our input, then starts passing it on.
-        #
-        # This won't do for a full solution; but it's plenty for replacing
-        # lots of shell scripts, where the data handled in pipes is not too
-        # many kilobytes.
-        inbuf = input.read() if stdin == subprocess.PIPE else None
-        outbuf, _ = proc.communicate(inbuf)
-        if stdout == subprocess.PIPE:
-            output.write(outbuf)
+            new_group=deadline.new_group(),
+    ) as proc, deadline.watching(proc):
+        try:
+            if subprocess.PIPE in (stdin, stdout):
+                pump(proc, input, output)
+            trace.wait(proc)
+        except BaseException:
+            proc.kill()
+            raise
 
     if _check:
         retcode = proc.returncode
@@ -246,6 +836,113 @@ def run(input, output, fmt, *args, _check=True, _stderr=None):
             raise subprocess.CalledProcessError(retcode, cmd)
 
 
+@pysh.filter
+@pysh.input(type='iter')
+@pysh.output(type='stream')
+@pysh.argument()
+@pysh.argument(n='*')
+@pysh.option('-P', type=int)
+@pysh.option('-n', type=int)
+def xargs(input, output, fmt, *args, jobs=1, ordered=True, max_args=None,
+          _check=True, _stderr=None):
+    '''
+    Run the given external command on the input items, in batches.
+
+    The command line is given by *fmt* and *\\*args*, as for `run`.
+    Each item of the input iterator, which should be `bytes` or `str`,
+    is one more argument to add at the end.  The items are packed into
+    as few commands as the system's limit on the size of a command
+    line allows, or with *max_args*, at most that many per command.
+    For example:
+
+    >>> pysh.to_stdout( cmd.run('find -name *.py -print0')
+    ...                 | cmd.splitlines(delim=b'\\0')
+    ...                 | cmd.xargs('wc -l') )
+
+    This corresponds to the Unix command ``xargs``, with *jobs* and
+    *max_args* corresponding to ``xargs -P`` and ``xargs -n``.
+
+    With *jobs* greater than 1, up to that many commands run at once.
+    Each command's output is then kept until it's complete, and
+    written in order; or if *ordered* is false, as soon as each
+    command completes.
+
+    The commands get ``/dev/null`` as their stdin.  *_check* and
+    *_stderr* are as for `run`; on a failure, any other commands
+    still running are killed.
+    '''
+    from pysh.subprocess import CmdPool
+    base = shwords(fmt, *args)
+    # A single command at a time can write straight to the output.
+    direct = jobs == 1 and has_fileno(output)
+    if direct:
+        output.flush()
+    pool = CmdPool(lambda batch: base + batch, jobs=jobs,
+                   capture=not direct, strip=False, check=_check,
+                   stdin=subprocess.DEVNULL, stdout=output if direct else None,
+                   stderr=_stderr, cwd=None, timeout=None)
+    batches = pack_args(input, base, max_args)
+    results = pool.map(batches, ordered)
+    if direct:
+        for _ in results:
+            pass
+        return
+    for result in results:
+        data = result if ordered else result[1]
+        if data:
+            output.write(data)
+
+
+# Room to leave in the command-line size limit, as in GNU xargs.
+ARG_HEADROOM = 2048
+
+
+def arg_limit() -> int:
+    '''
+    How many bytes of arguments a command we start can take.
+
+    This is the system's limit `ARG_MAX` less our environment, which
+    counts against the same limit, and some room to spare.
+    '''
+    try:
+        arg_max = os.sysconf('SC_ARG_MAX')
+    except (ValueError, OSError):
+        arg_max = -1
+    if arg_max <= 0:
+        arg_max = 4096  # The minimum POSIX allows.
+    env_size = sum(arg_size(key) + arg_size(value)
+                   for key, value in os.environb.items())
+    return arg_max - env_size - ARG_HEADROOM
+
+
+def arg_size(arg) -> int:
+    # Each argument takes its length, a NUL, and a pointer to it.
+    return len(os.fsencode(arg)) + 1 + 8
+
+
+def pack_args(items, base: List, max_args=None):
+    '''
+    Pack `items` into lists, to add to the command line `base` in turn.
+
+    Each list is as long as fits within `arg_limit`, and `max_args`.
+    '''
+    limit = arg_limit() - sum(arg_size(arg) for arg in base)
+    batch = []  # type: List
+    size = 0
+    for item in items:
+        if isinstance(item, memoryview):
+            # E.g. from `splitlines(views=True)`; only valid until the next.
+            item = bytes(item)
+        item_size = arg_size(item)
+        if batch and (size + item_size > limit or len(batch) == max_args):
+            yield batch
+            batch, size = [], 0
+        batch.append(item)
+        size += item_size
+    if batch:
+        yield batch
+
+
 # TODO -- Features needed for translating everyday shell scripts without bloat.
 #  [x] CLI parsing (use Click)
 #  [x] pipelines, with split
@@ -255,14 +952,14 @@ def run(input, output, fmt, *args, _check=True, _stderr=None):
 #  [x] shwords for lists: `{!@}`
 #  [x] `run` accept input
 #  [x] `echo` builtin: `echo "$foo" | ...`
-#  [ ] `join` inverse of `split`
+#  [x] `join` inverse of `split`
 #  [x] redirect `2>/dev/null` and `2>&`; perhaps e.g.
 #      `cmd.run(..., _stderr=cmd.DEVNULL)` (and let other kwargs
 #      go to shwords)?
 #  [ ] globs (check if stdlib glob is enough)
 #
 # Nice to have:
-#  [ ] async
+#  [x] async
 #  [ ] maybe some sugar for functions like this:
 #        run() { lxc-attach -n "$CONTAINER_NAME" -- "$@"; }
 #      Already not too hard to write with `shwords` and `{!@}`, though.
@@ -0,0 +1,201 @@
+'''
+Deadlines for whole pipelines, as for the *timeout* of `.slurp()`.
+
+While a deadline is in effect, each external command run as a
+pipeline stage, as by `.cmd.run`, starts in a process group of its
+own.  When the deadline passes, each such group still running gets
+SIGTERM, and then after `GRACE_PERIOD` seconds, SIGKILL.  So the
+whole pipeline winds down promptly, including any processes the
+commands have started in turn.
+
+A stage written in Python can't be stopped this way.  But once the
+external commands around it are gone, its input reaches end of file,
+or its output is a broken pipe; so typically it finishes soon after.
+
+A `Deadline` with no timeout is a way to stop a set of commands on
+demand instead, with `Deadline.expire`.  Each stage running in the
+background of a pipeline has one, so it can be cancelled if the
+consumer stops early; see `.filters.StageThread`.  Those commands
+aren't given process groups of their own, so only they are signalled,
+and not their children.
+'''
+
+import os
+import signal
+import threading
+from typing import Callable, Optional
+
+#: After SIGTERM, how long commands have to exit before SIGKILL.
+GRACE_PERIOD = 1.0
+
+local = threading.local()
+
+
+def current() -> Optional['Deadline']:
+    '''The innermost deadline in effect in this thread, if any.'''
+    return getattr(local, 'deadline', None)
+
+
+def new_group() -> bool:
+    '''Whether a command started now should be in a process group of its own.'''
+    deadline = current()
+    while deadline is not None:
+        if deadline.timeout is not None:
+            return True
+        deadline = deadline.outer
+    return False
+
+
+def inherit(func: Callable) -> Callable:
+    '''
+    Wrap `func` to run under the deadlines now in effect, in any thread.
+
+    Use this for a function to run in another thread on behalf of this
+    one, like a pipeline stage.
+    '''
+    deadline = current()
+    if deadline is None:
+        return func
+
+    def run(*args, **kwargs):
+        outer = current()
+        local.deadline = deadline
+        try:
+            return func(*args, **kwargs)
+        finally:
+            local.deadline = outer
+    return run
+
+
+class Deadline:
+    '''
+    Context manager: a deadline *timeout* seconds from now, in this thread.
+
+    Other threads working for this one get it too, through `inherit`.
+    Deadlines may be nested; each applies to the commands run within.
+
+    If *timeout* is None, the deadline passes only when `expire` is
+    called.
+    '''
+
+    def __init__(self, timeout: Optional[float]) -> None:
+        self.timeout = timeout
+        self.expired = False
+        self.killed = False
+        self.finished = False
+        self.procs = set()  # type: set
+        self.lock = threading.Lock()
+        self.timers = []  # type: list
+
+    def __enter__(self):
+        self.outer = current()
+        local.deadline = self
+        if self.timeout is not None:
+            with self.lock:
+                self.start_timer(self.timeout, self.expire)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        local.deadline = self.outer
+        with self.lock:
+            self.finished = True
+            for timer in self.timers:
+                timer.cancel()
+
+    def start_timer(self, delay: float, func: Callable) -> None:
+        timer = threading.Timer(delay, func)
+        timer.daemon = True
+        self.timers.append(timer)
+        timer.start()
+
+    def expire(self) -> None:
+        '''Stop the commands now: SIGTERM, and later SIGKILL.'''
+        with self.lock:
+            if self.finished:
+                return
+            self.expired = True
+            self.signal_all(signal.SIGTERM)
+            self.start_timer(GRACE_PERIOD, self.kill)
+
+    def kill(self) -> None:
+        with self.lock:
+            if self.finished:
+                return
+            self.killed = True
+            self.signal_all(signal.SIGKILL)
+
+    def signal_all(self, sig: int) -> None:
+        for proc in self.procs:
+            signal_proc(proc, sig)
+
+    def add(self, proc) -> None:
+        with self.lock:
+            self.procs.add(proc)
+            if self.killed:
+                signal_proc(proc, signal.SIGKILL)
+            elif self.expired:
+                signal_proc(proc, signal.SIGTERM)
+
+    def discard(self, proc) -> None:
+        with self.lock:
+            self.procs.discard(proc)
+
+
+def signal_proc(proc, sig: int) -> None:
+    '''Send `sig` to `proc`, and its whole group if it leads one.'''
+    if not getattr(proc, 'new_group', False):
+        proc.send_signal(sig)
+        return
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass  # Already gone, and perhaps its ID reused by a stranger.
+
+
+class watching:
+    '''
+    Context manager: apply the deadlines in effect to the process *proc*.
+
+    The process should be started by `.spawn.popen`, with *new_group*
+    as given by `new_group`; and the context should last until it has
+    been waited for.
+    '''
+
+    def __init__(self, proc) -> None:
+        self.proc = proc
+        self.deadlines = []
+        deadline = current()
+        while deadline is not None:
+            self.deadlines.append(deadline)
+            deadline = deadline.outer
+
+    def __enter__(self):
+        for deadline in self.deadlines:
+            deadline.add(self.proc)
+        return self.proc
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        for deadline in self.deadlines:
+            deadline.discard(self.proc)
+
+
+def run(func: Callable, timeout: Optional[float], cmd):
+    '''
+    Call `func()` under a deadline of *timeout* seconds, if not None.
+
+    If the deadline passes before `func` returns, raises
+    :class:`subprocess.TimeoutExpired` for *cmd*.
+    '''
+    if timeout is None:
+        return func()
+    with Deadline(timeout) as deadline:
+        try:
+            result = func()
+        except Exception:
+            if not deadline.expired:
+                raise
+            result = None
+    if deadline.expired:
+        import subprocess
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    return result
@@ -1,28 +1,210 @@
 from collections import namedtuple
-import io
+import os
+import select
+import signal
+import subprocess
 import sys
-from typing import Any, Callable, List, NamedTuple
+import threading
+from typing import (
+    Any, Callable, Dict, List, NamedTuple, Optional, Tuple,
+)
 
+from . import deadline, trace
+
+
+class StageThread(threading.Thread):
+    '''Runs one stage of a pipeline, writing into a pipe, in the background.'''
+
+    def __init__(self, filter: 'Filter', input, output) -> None:
+        super().__init__(daemon=True)
+        self.filter = filter
+        self.input = input
+        self.output = output
+        self.exception = None
+        # Whether the consumer closed the pipe before reading all of it.
+        self.cut_off = False
+        # The commands this stage runs, to stop if it's cancelled.
+        self.commands = deadline.Deadline(None)
+        self.thunk = deadline.inherit(self.run_stage)
+
+    def run_stage(self) -> None:
+        with self.commands:
+            self.filter.thunk(self.input, self.output)
+
+    def run(self) -> None:
+        try:
+            self.thunk()
+        except BaseException as e:
+            self.exception = e
+        finally:
+            try:
+                self.output.close()
+            except BrokenPipeError as e:
+                if self.exception is None:
+                    self.exception = e
+
+    def cancel(self) -> None:
+        '''
+        Stop the stage early, because its output is no longer wanted.
+
+        The consumer should already have closed the pipe from the stage,
+        so writing to it fails.  Any external commands the stage is
+        running are also terminated, in case they're busy not writing.
+        '''
+        self.commands.expire()
+
+    def finish(self) -> None:
+        '''Wait for the stage to complete, and raise any exception it raised.'''
+        self.join()
+        exception = self.exception
+        if self.cut_off and broken_pipe(exception):
+            # The consumer stopped reading; like a shell, we don't
+            # consider that a failure of the pipeline.
+            return
+        if exception is not None:
+            raise exception
+
+
+def broken_pipe(exception: Optional[BaseException]) -> bool:
+    '''Whether `exception` is a stage's failure to write to a closed pipe.'''
+    if isinstance(exception, BrokenPipeError):
+        return True
+    # An external command, as by `.cmd.run`, dies of SIGPIPE instead.
+    return (isinstance(exception, subprocess.CalledProcessError)
+            and exception.returncode == -signal.SIGPIPE)
+
+
+def at_eof(reader) -> bool:
+    '''
+    Whether everything has been read from the pipe `reader`, as from
+    `open_pipe`.
+
+    If not, then closing it cuts off the writer, which gets a broken pipe.
+    '''
+    f = getattr(reader, 'buffer', reader)
+    if f.closed:
+        return False
+    readable, _, _ = select.select([f], [], [], 0)
+    # Readable, so `peek` won't block; it's empty only at end of file.
+    return bool(readable) and not f.peek(1)
+
+
+def open_pipe(text: bool):
+    '''Make an OS pipe, returning file objects for its (read, write) ends.'''
+    readfd, writefd = os.pipe()
+    if text:
+        # The text is only ever read back by another stage in the
+        # same process, so no need to consult the locale.
+        options = dict(encoding='utf-8', errors='surrogatepass', newline='')
+        return open(readfd, 'r', **options), open(writefd, 'w', **options)
+    return open(readfd, 'rb'), open(writefd, 'wb')
+
+
+def pipe_by_os_pipe(left: 'Filter', right: 'Filter', text: bool):
+    # Both stages run at once: `left` in a background thread, writing
+    # into a pipe, and `right` in the caller's thread, reading from it.
+    # The pipe buffer bounds memory use, and provides backpressure.
+    def start(input):
+        reader, writer = open_pipe(text)
+        thread = StageThread(left, input, writer)
+        thread.start()
+        return reader, thread
+
+    def finish(reader, thread):
+        # If `right` stopped reading early, like `cmd.head`, then `left`
+        # gets a broken pipe when it next writes, and stops.  That's
+        # fine; but a broken pipe it got otherwise is a failure.
+        thread.cut_off = not at_eof(reader)
+        reader.close()
+        thread.finish()
+
+    def abandon(reader, thread):
+        # `right` failed, or its consumer stopped; don't wait on `left`.
+        reader.close()
+        thread.cancel()
+        thread.join()
 
-def pipe_by_stream(left: 'Filter', right: 'Filter'):
-    # TODO this exhausts left, then starts right.
-    # This is where we really need async.
     def piped(input, output):
-        buf = io.BytesIO()
-        left.thunk(input, buf)
-        buf.seek(0)
-        return right.thunk(buf, output)
-    return piped
+        # When one side is just a file, skip the pipe and the thread,
+        # and hand the other side the file itself.
+        source = left.source_file(input)
+        if source is not None:
+            with source:
+                return right.thunk(source, output)
+        sink = right.sink_file(output)
+        if sink is not None:
+            with sink:
+                left.thunk(input, sink)
+            return None
+
+        reader, thread = start(input)
+        try:
+            result = right.thunk(reader, output)
+        except BaseException:
+            abandon(reader, thread)
+            raise
+        finish(reader, thread)
+        return result
+
+    def piped_iter(input, _):
+        # Nothing starts until the consumer starts iterating.
+        source = left.source_file(input)
+        if source is not None:
+            with source:
+                yield from right.thunk(source, None)
+            return
+
+        reader, thread = start(input)
+        try:
+            yield from right.thunk(reader, None)
+        except BaseException:
+            # Including `GeneratorExit`, if the consumer stopped early.
+            abandon(reader, thread)
+            raise
+        finish(reader, thread)
+
+    return piped_iter if right.output.type == 'iter' else piped
+
+
+def pipe_by_stream(left: 'Filter', right: 'Filter'):
+    return pipe_by_os_pipe(left, right, text=False)
 
 
 def pipe_by_tstream(left: 'Filter', right: 'Filter'):
-    # TODO this exhausts left, then starts right.
-    # This is where we really need async.
+    return pipe_by_os_pipe(left, right, text=True)
+
+
+def close_iterator(iterator) -> None:
+    close = getattr(iterator, 'close', None)
+    if close is not None:
+        close()
+
+
+def pipe_by_iter(left: 'Filter', right: 'Filter'):
+    # The left side's iterator is the right side's input; nothing is
+    # computed until the right side asks for it.  When the right side
+    # is done, close the left side's iterator, so it can clean up
+    # promptly even if the right side didn't consume all of it.
+    def piped(input, output):
+        items = left.thunk(input, None)
+        try:
+            return right.thunk(items, output)
+        finally:
+            close_iterator(items)
+
+    def piped_iter(input, _):
+        items = left.thunk(input, None)
+        try:
+            yield from right.thunk(items, None)
+        finally:
+            close_iterator(items)
+
+    return piped_iter if right.output.type == 'iter' else piped
+
+
+def pipe_by_bytes(left: 'Filter', right: 'Filter'):
     def piped(input, output):
-        buf = io.StringIO()
-        left.thunk(input, buf)
-        buf.seek(0)
-        return right.thunk(buf, output)
+        return right.thunk(left.thunk(input, None), output)
     return piped
 
 
@@ -40,17 +222,39 @@ class Filter:
     output: IoSpec
     thunk: Callable[[Any, Any], None]
 
-    def __init__(self, input, output, thunk):
+    # If made by the pipe operator as `left | right`, the pair (left, right).
+    pipe: Optional[Tuple['Filter', 'Filter']]
+
+    # If made by calling a `Function`, that function and the arguments.
+    function: Optional['Function']
+    args: Tuple
+    kwargs: Dict[str, Any]
+
+    def __init__(self, input, output, thunk, *,
+                 pipe=None, function=None, args=(), kwargs={}):
         self.input = input
         self.output = output
         self.thunk = thunk
+        self.pipe = pipe
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        # This pipeline as rewritten by `optimize`, once planned.
+        self.optimized = None  # type: Optional[Filter]
+
+    def __repr__(self) -> str:
+        if self.pipe is not None:
+            return '{!r} | {!r}'.format(*self.pipe)
+        if self.function is not None:
+            return self.function.describe(self.args, self.kwargs)
+        return '<Filter {} -> {}>'.format(self.input.type, self.output.type)
 
     def __call__(self):
         if self.input.required:
             raise RuntimeError()
         if self.output.required and Filter.pass_output(self.output):
             raise NotImplementedError()  # Probably return the pipe/stream.
-        return self.thunk(None, None)
+        return optimize(self).thunk(None, None)
 
     def __iter__(self):
         if self.output.type in ('none', 'stream', 'tstream', 'bytes'):
@@ -58,21 +262,67 @@ class Filter:
         assert self.output.type in ('iter',)
         return self()
 
+    def source_file(self, input):
+        '''
+        A file to read this filter's output from, in place of running it.
+
+        Returns None if the filter must be run normally instead.
+        See `Function.source`.
+        '''
+        function = self.function
+        if function is None or function.source is None:
+            return None
+        return function.source(input, *self.args, **self.kwargs)
+
+    def sink_file(self, output):
+        '''
+        A file to write this filter's input to, in place of running it.
+
+        Returns None if the filter must be run normally instead.
+        See `Function.sink`.
+        '''
+        function = self.function
+        if function is None or function.sink is None:
+            return None
+        return function.sink(output, *self.args, **self.kwargs)
+
+    def rewrite(self, following: 'Filter') -> Optional[List['Filter']]:
+        '''
+        Stages to replace this filter and `following`, when piped together.
+
+        Returns None if there's no such rewrite.  See `Function.rewrite`.
+        '''
+        function = self.function
+        if function is None or function.rewrite is None:
+            return None
+        return function.rewrite(following, *self.args, **self.kwargs)
+
+    def __aiter__(self):
+        if self.output.type in ('none', 'stream', 'tstream', 'bytes'):
+            raise RuntimeError()
+        assert self.output.type in ('iter',)
+        if self.input.required:
+            raise RuntimeError()
+        from .asyncio import aiter_thunk
+        return aiter_thunk(optimize(self), None)
+
     def __or__(self, other: 'Filter'):
         '''Aka `|` -- the pipe operator.'''
         if self.output.type != other.input.type:
             raise RuntimeError()
         if self.output.type in ('none',):
             raise RuntimeError()
-        elif self.output.type in ('iter', 'bytes'):
-            raise NotImplementedError()
-        assert self.output.type in ('stream', 'tstream')
+        assert self.output.type in ('stream', 'tstream', 'iter', 'bytes')
 
         if self.output.type == 'stream':
             thunk = pipe_by_stream(self, other)
-        else:
+        elif self.output.type == 'tstream':
             thunk = pipe_by_tstream(self, other)
-        return Filter(self.input, other.output, thunk)
+        elif self.output.type == 'iter':
+            thunk = pipe_by_iter(self, other)
+        else:
+            thunk = pipe_by_bytes(self, other)
+        return Filter(self.input, other.output, thunk, pipe=(self, other))
 
 
     @staticmethod
@@ -94,35 +344,217 @@ class Filter:
         assert False
 
 
+def stages(filter: Filter) -> List[Filter]:
+    '''The stages of the pipeline `filter`, in order, however it's nested.'''
+    if filter.pipe is None:
+        return [filter]
+    left, right = filter.pipe
+    return stages(left) + stages(right)
+
+
+def optimize(filter: Filter) -> Filter:
+    '''
+    Plan the pipeline `filter`: an equivalent pipeline, to run in its place.
+
+    The pipeline is regrouped from the left, as ``(a | b) | c``; so
+    each stage meets the next directly, and a stage like `.cmd.devnull`
+    can pass a file straight to the stage before it.  Adjacent stages
+    are rewritten where their `Function.rewrite` says, as for a
+    `.cmd.decode` and `.cmd.encode` that cancel out.
+
+    Running a pipeline, as by `slurp`, does this first.  The result is
+    kept, so it's done just once for each pipeline.  See `explain` to
+    see the result.
+    '''
+    if filter.optimized is not None:
+        return filter.optimized
+    if filter.pipe is None:
+        filter.optimized = filter
+        return filter
+
+    planned = []  # type: List[Filter]
+    for stage in stages(filter):
+        planned.append(stage)
+        while len(planned) >= 2:
+            replacement = planned[-2].rewrite(planned[-1])
+            if replacement is None:
+                break
+            planned[-2:] = replacement
+    if not planned:
+        # It all cancelled out; but it's simplest to just run it.
+        planned = stages(filter)
+
+    result = planned[0]
+    for stage in planned[1:]:
+        result = result | stage
+    result.optimized = result
+    filter.optimized = result
+    return result
+
+
+def read_stripped(input, spill: Optional[int] = None):
+    '''
+    Read all of `input`, stripping any trailing newlines.
+
+    If `spill` is None, or the data fits within `spill` bytes, returns
+    a `bytes`.  Otherwise, the data is written to an anonymous
+    temporary file as it arrives, and the result is a read-only
+    `memoryview` of it mapped into memory; so it takes memory only as
+    the OS pages it in.
+    '''
+    if spill is None:
+        return input.read().rstrip(b'\n')
+
+    buffered = []
+    size = 0
+    while size <= spill:
+        chunk = input.read1(65536)
+        if not chunk:
+            return b''.join(buffered).rstrip(b'\n')
+        buffered.append(chunk)
+        size += len(chunk)
+
+    import mmap
+    import tempfile
+    with tempfile.TemporaryFile() as f:
+        f.writelines(buffered)
+        del buffered
+        for chunk in iter(lambda: input.read1(65536), b''):
+            f.write(chunk)
+        f.flush()
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    # Strip newlines by shortening the view, rather than copying.
+    end = len(view)
+    while end and view[end - 1] == ord('\n'):
+        end -= 1
+    return view[:end]
+
+
 slurp_filter = Filter(IoSpec('stream'), IoSpec('bytes'),
-                     lambda input, _: input.read().rstrip(b'\n'))
+                     lambda input, _: read_stripped(input))
 
-def slurp(filter):
+def slurp(filter, *, spill: Optional[int] = None,
+          timeout: Optional[float] = None):
     '''
     Run the pipeline and capture output, stripping any trailing newlines.
 
     Stripping trailing newlines is the same behavior as ``$(...)`` has
     in Bash.  It fits nicely with conventional semantics for Unix CLI tools.
 
+    If *spill* is given, output larger than that many bytes is not
+    kept in memory.  Instead it goes to an anonymous temporary file,
+    and the result is a read-only :class:`memoryview` of the file,
+    mapped with :mod:`mmap`, rather than a `bytes`.
+
+    If *timeout* is given, the whole pipeline has that many seconds
+    to finish; then its commands are stopped, and this raises
+    :class:`subprocess.TimeoutExpired`.  See `pysh.deadline`.
+
     See also `pysh.slurp_cmd`.
     '''
     # For reference on `$(...)` see Bash manual, 3.5.4 Command Substitution.
-    return (filter | slurp_filter)()
+    if spill is None:
+        pipeline = filter | slurp_filter
+    else:
+        pipeline = filter | Filter(
+            IoSpec('stream'), IoSpec('bytes'),
+            lambda input, _: read_stripped(input, spill))
+    return deadline.run(pipeline, timeout, filter)
 
 
-def to_stdout(filter):
+def to_stdout(filter, *, timeout: Optional[float] = None):
     '''
     Run the pipeline, with output directed to our stdout.
+
+    A *timeout* applies to the whole pipeline, as for `slurp`.
+    '''
+    if filter.input.required:
+        raise RuntimeError()
+    if filter.output.type in ('none', 'iter', 'bytes'):
+        raise RuntimeError()
+    assert filter.output.type in ('stream', 'tstream')
+    # Anything we've already printed must come before the pipeline's output.
+    sys.stdout.flush()
+    output = sys.stdout.buffer if filter.output.type == 'stream' else sys.stdout
+    thunk = optimize(filter).thunk
+    deadline.run(lambda: thunk(None, output), timeout, filter)
+
+
+def to_file(filter, path, *, append: bool = False,
+            timeout: Optional[float] = None) -> None:
+    '''
+    Run the pipeline, with output directed to the file *path*.
+
+    This is like the shell redirection ``>path``, or with *append*,
+    ``>>path``.  The pipeline's last stage writes to the file itself;
+    so if that's an external command, it gets the file as its stdout,
+    and the output never passes through Python.
+
+    A *timeout* applies to the whole pipeline, as for `slurp`.
     '''
     if filter.input.required:
         raise RuntimeError()
     if filter.output.type in ('none', 'iter', 'bytes'):
         raise RuntimeError()
     assert filter.output.type in ('stream', 'tstream')
+    mode = 'a' if append else 'w'
     if filter.output.type == 'stream':
-        filter.thunk(None, sys.stdout.buffer)
-    else:
-        filter.thunk(None, sys.stdout)
+        mode += 'b'
+    thunk = optimize(filter).thunk
+    with open(path, mode) as output:
+        deadline.run(lambda: thunk(None, output), timeout, filter)
+
+
+def explain(filter, file=None) -> None:
+    '''
+    Print how the pipeline will run: its stages, and how each is connected.
+
+    This is the pipeline as planned by `optimize`.  The output goes to
+    *file*, by default our stdout.  For example:
+
+    >>> pysh.explain( cmd.read_file('/etc/shells') | cmd.run('sort')
+    ...               | cmd.splitlines() )
+    read_file('/etc/shells')
+      -> file, read directly by the next stage
+    run('sort')
+      -> OS pipe, from a background thread
+    splitlines()
+
+    Nothing is run, and no files are opened.  A stage that can pass
+    a file directly is shown doing so, though when run it may decline,
+    as `.cmd.cat` does for several files.
+    '''
+    planned = stages(optimize(filter))
+    lines = [repr(planned[0])]
+    for i in range(1, len(planned)):
+        connection = describe_connection(planned[i - 1], planned[i], i == 1)
+        lines.append('  -> ' + connection)
+        lines.append(repr(planned[i]))
+    print('\n'.join(lines), file=file)
+
+
+def has_hook(filter: Filter, name: str) -> bool:
+    function = filter.function
+    return function is not None and getattr(function, name) is not None
+
+
+def describe_connection(left: Filter, right: Filter, first: bool) -> str:
+    '''How `left | right` passes data, within an `optimize`d pipeline.'''
+    # Compare `pipe_by_os_pipe` and the rest.
+    if left.output.type == 'iter':
+        return 'iterator, in the same thread'
+    if left.output.type == 'bytes':
+        return 'value, in the same thread'
+    # Hooks would open files, perhaps failing, or truncating one for
+    # writing; so just see that there is one.  A source hook only sees
+    # the pipeline's first stage alone, as `optimize` groups from the
+    # left; any other has some input, which the hooks decline.
+    if first and has_hook(left, 'source'):
+        return 'file, read directly by the next stage'
+    if has_hook(right, 'sink'):
+        return 'file, written directly by the previous stage'
+    return 'OS pipe, from a background thread'
 
 
 Argspec = namedtuple('Argspec', ['type', 'n'])
@@ -136,12 +568,38 @@ class Function:
     output: IoSpec
     argspecs: List[Argspec]
 
+    # An optional coroutine function, taking the same arguments as
+    # `func`, for running the filter on an asyncio event loop.
+    # If the output type is 'iter', an async generator function instead.
+    afunc: Optional[Callable]
+
+    # Optional functions for when running the filter is equivalent to
+    # reading from, or writing to, a file.  Each takes the filter's
+    # input or output respectively (or None), then the same arguments
+    # as `func`, and returns a new file object, or None if the filter
+    # must be run normally after all.  The pipe operator uses these to
+    # hand the file straight to the adjacent stage, so that e.g. an
+    # external command gets its file descriptor directly.
+    source: Optional[Callable]
+    sink: Optional[Callable]
+
+    # An optional function for when this filter and the one after it
+    # in a pipeline are equivalent to something simpler.  It takes the
+    # following `Filter`, then the same arguments as `func`, and
+    # returns a list of filters to replace the two, or None to leave
+    # them be.  Used by `optimize`.
+    rewrite: Optional[Callable]
+
     def __init__(self, func):
         self.func = func
         self.__doc__ = func.__doc__
         self.input = getattr(func, 'input', IoSpec())
         self.output = getattr(func, 'output', IoSpec())
         self.argspecs = getattr(func, 'argspecs', [])
+        self.afunc = None
+        self.source = None
+        self.sink = None
+        self.rewrite = None
 
     @property  # TODO(py38+): use functools.cached_property
     def __signature__(self):
@@ -152,18 +610,56 @@ class Function:
         return inner.replace(parameters=parameters)
 
     def __call__(self, *args, **kwargs):
+        def name():
+            return self.describe(args, kwargs)
+        thunk = trace.instrumented(name, self.input.type, self.output.type,
+                                   self.bind(self.func, args, kwargs))
+        return Filter(self.input, self.output, thunk,
+                      function=self, args=args, kwargs=kwargs)
+
+    def describe(self, args, kwargs) -> str:
+        '''A description of a call with these arguments, like ``run('ls')``.'''
+        return '{}({})'.format(self.func.__name__, ', '.join(
+            [repr(arg) for arg in args]
+            + ['{}={!r}'.format(*item) for item in kwargs.items()]))
+
+    def bind(self, func, args, kwargs):
+        '''Make a thunk calling `func` like `func`, with the given arguments.'''
         pass_input = Filter.pass_input(self.input)
         pass_output = Filter.pass_output(self.output)
         if pass_input and pass_output:
-            thunk = (lambda input, output:
-                     self.func(input, output, *args, **kwargs))
+            return (lambda input, output:
+                    func(input, output, *args, **kwargs))
         elif pass_input:
-            thunk = lambda input, _: self.func(input, *args, **kwargs)
+            return lambda input, _: func(input, *args, **kwargs)
         elif pass_output:
-            thunk = lambda _, output: self.func(output, *args, **kwargs)
+            return lambda _, output: func(output, *args, **kwargs)
         else:
-            thunk = lambda: self.func(*args, **kwargs)
-        return Filter(self.input, self.output, thunk)
+            return lambda _, __: func(*args, **kwargs)
+
+    def asynchronous(self, afunc):
+        '''
+        Decorator to provide an asyncio implementation of this filter.
+
+        Returns *afunc* unchanged.
+        '''
+        self.afunc = afunc
+        return afunc
+
+    def as_source(self, source):
+        '''Decorator to set `source`.  Returns *source* unchanged.'''
+        self.source = source
+        return source
+
+    def as_sink(self, sink):
+        '''Decorator to set `sink`.  Returns *sink* unchanged.'''
+        self.sink = sink
+        return sink
+
+    def as_rewrite(self, rewrite):
+        '''Decorator to set `rewrite`.  Returns *rewrite* unchanged.'''
+        self.rewrite = rewrite
+        return rewrite
 
 
 def filter(func):
@@ -0,0 +1,493 @@
+'''
+An optional helper process, to start commands on our behalf.
+
+Starting a command from a big Python process costs more as the
+process grows: ``fork`` copies its page tables, and even ``vfork``
+must contend with its many threads and their locks.  A launcher is a
+small separate process, started early while we're still small, that
+starts each command for us, so that the cost stays the same whatever
+becomes of the parent.
+
+To use it, call `start` early on, for example first thing in ``main``.
+After that, the commands pysh runs with `.check_cmd()`,
+`.slurp_cmd()`, `.cmd.run`, and the rest go through the launcher:
+
+>>> pysh.launcher.start()
+>>> pysh.slurp_cmd('echo {}', 'hi')
+b'hi'
+
+Each command still sees just what it would if we'd started it
+ourselves: our current working directory and environment, and the
+file descriptors it's given, all sent over a Unix socket.  The
+launcher reports back when the command exits, so that the
+`subprocess.Popen`-like object we return behaves as usual.
+The command is a child of the launcher, not of our process.
+
+The exceptions are those started other than by `.spawn.popen`: by the
+``_f`` variants like `.check_cmd_f()`, and by `pysh.asyncio`.  Those
+are always started directly.
+
+If the launcher dies, commands are started directly again.
+'''
+
+import array
+import os
+import pickle
+import selectors
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+# NB this module also runs as a script, as the launcher itself; so it
+# imports only from the standard library.
+
+
+# Messages are pickles, each prefixed by its length.  Only the two ends
+# of a private socket pair are ever talking.
+LENGTH = struct.Struct('!I')
+
+
+def send_obj(sock: socket.socket, obj) -> None:
+    data = pickle.dumps(obj)
+    sock.sendall(LENGTH.pack(len(data)) + data)
+
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+def recv_obj(sock: socket.socket):
+    '''The next object sent by `send_obj`; or raise `EOFError`.'''
+    size, = LENGTH.unpack(recv_exactly(sock, LENGTH.size))
+    return pickle.loads(recv_exactly(sock, size))
+
+
+class Unavailable(Exception):
+    '''The launcher can't take commands, as it has exited or was stopped.'''
+
+
+#
+# The launcher's end.
+#
+
+# The most file descriptors in one request: a socket for the reply,
+# then stdin, stdout, stderr.
+MAX_FDS = 4
+
+
+def serve(control: socket.socket) -> None:
+    '''Start commands as requested on `control`, until it's closed.'''
+    # Wake up on SIGCHLD, to report on commands that exit.  A handler
+    # that does nothing, unlike SIG_IGN, is reset by `exec` in each
+    # command; likewise for SIGINT, which our parent gets to handle.
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda *_: None)
+    signal.signal(signal.SIGINT, lambda *_: None)
+
+    running = {}  # pid -> (Popen, socket for the reply)
+    selector = selectors.DefaultSelector()
+
+    def reap():
+        for pid, (proc, conn) in list(running.items()):
+            pid, status, rusage = os.wait4(pid, os.WNOHANG)
+            if not pid:
+                continue
+            # py38: os.waitstatus_to_exitcode is new in Python 3.9.
+            if os.WIFSIGNALED(status):
+                proc.returncode = -os.WTERMSIG(status)
+            else:
+                proc.returncode = os.WEXITSTATUS(status)
+            try:
+                send_obj(conn, (proc.returncode, rusage))
+            except OSError:
+                pass  # The requester is gone; fine.
+            if conn in selector.get_map():
+                selector.unregister(conn)
+            conn.close()
+            del running[pid]
+
+    def signal_command(conn, pid):
+        # Until `reap` has waited for it, the pid can't have been reused.
+        try:
+            sig = recv_obj(conn)
+        except (OSError, EOFError):
+            selector.unregister(conn)  # The requester is gone.
+            return
+        if pid in running:
+            os.kill(pid, sig)
+
+    with selector:
+        selector.register(control, selectors.EVENT_READ)
+        selector.register(wakeup_read, selectors.EVENT_READ)
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is control:
+                    fds = recv_fds(control)
+                    if fds is None:
+                        return  # Our parent is done.
+                    conn = socket.socket(fileno=fds[0])
+                    proc = launch(conn, fds[1:])
+                    if proc is None:
+                        conn.close()
+                    else:
+                        running[proc.pid] = (proc, conn)
+                        # Requests to signal the command come here.
+                        selector.register(conn, selectors.EVENT_READ,
+                                          proc.pid)
+                elif key.fileobj is wakeup_read:
+                    os.read(wakeup_read, 4096)
+                else:
+                    signal_command(key.fileobj, key.data)
+            reap()
+
+
+def recv_fds(control: socket.socket):
+    '''Receive one request's file descriptors; or None at end of file.'''
+    fds = array.array('i')
+    msg, ancdata, _, _ = control.recvmsg(
+        1, socket.CMSG_SPACE(MAX_FDS * fds.itemsize))
+    if not msg:
+        return None
+    for level, type, data in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    return list(fds)
+
+
+def launch(conn: socket.socket, stdio):
+    '''Start the command requested on `conn`; report its pid, or the error.'''
+    try:
+        request = recv_obj(conn)
+        proc = subprocess.Popen(
+            request['args'],
+            stdin=stdio[0], stdout=stdio[1], stderr=stdio[2],
+            cwd=request['cwd'], env=request['env'],
+            **request['options']
+        )
+    except Exception as e:
+        try:
+            send_obj(conn, (None, e))
+        except OSError:
+            pass
+        return None
+    finally:
+        for fd in stdio:
+            os.close(fd)
+    send_obj(conn, (proc.pid, None))
+    return proc
+
+
+#
+# Our end.
+#
+
+class Launcher:
+    '''
+    A running launcher process, and our connection to it.
+
+    Normally there's just the one, from `start`.
+    '''
+
+    def __init__(self) -> None:
+        self.socket, theirs = socket.socketpair()
+        with theirs:
+            # Isolated mode (-I) keeps our own directory, with modules
+            # like `pysh.subprocess`, off the launcher's `sys.path`.
+            self.process = subprocess.Popen(
+                [sys.executable, '-I', os.path.abspath(__file__),
+                 str(theirs.fileno())],
+                pass_fds=[theirs.fileno()],
+                stdin=subprocess.DEVNULL,
+            )
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def close(self) -> None:
+        '''Stop the launcher.  Commands it started are unaffected.'''
+        self.closed = True
+        self.socket.close()
+        self.process.wait()
+
+    def launch(self, args, *, stdin=None, stdout=None, stderr=None,
+               cwd=None, **options) -> 'LaunchedProcess':
+        '''
+        Start a command, just like `subprocess.Popen` with these arguments.
+
+        Any further *options* are passed to `subprocess.Popen` as they
+        are, in the launcher; like ``process_group``.
+
+        Raises `Unavailable` if the launcher can't take the command.
+        '''
+        if self.closed or os.getpid() != self.pid:
+            # Stopped; or we're a forked child, sharing the socket.
+            raise Unavailable()
+        conn, theirs = socket.socketpair()
+        to_close = []  # Ends to close once sent, as in `subprocess`.
+        pipes = [None, None, None]
+        try:
+            fds = []
+            for std_fd, target in enumerate((stdin, stdout, stderr)):
+                if target is None:
+                    fd = std_fd
+                elif target == subprocess.PIPE:
+                    read_fd, write_fd = os.pipe()
+                    if std_fd == 0:
+                        fd, pipes[0] = read_fd, open(write_fd, 'wb')
+                    else:
+                        fd, pipes[std_fd] = write_fd, open(read_fd, 'rb')
+                    to_close.append(fd)
+                elif target == subprocess.DEVNULL:
+                    fd = os.open(os.devnull, os.O_RDWR)
+                    to_close.append(fd)
+                elif target == subprocess.STDOUT:
+                    fd = fds[1]
+                elif isinstance(target, int):
+                    fd = target
+                else:
+                    fd = target.fileno()
+                fds.append(fd)
+
+            request = dict(
+                args=list(args),
+                cwd=os.path.abspath(cwd if cwd is not None else os.curdir),
+                env=dict(os.environb),
+                options=options,
+            )
+            try:
+                with self.lock:
+                    self.socket.sendmsg(
+                        [b'L'],
+                        [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                          array.array('i', [theirs.fileno()] + fds))])
+                theirs.close()
+                send_obj(conn, request)
+                pid, error = recv_obj(conn)
+            except (OSError, EOFError) as e:
+                self.closed = True
+                raise Unavailable() from e
+        except BaseException:
+            conn.close()
+            for pipe in pipes:
+                if pipe is not None:
+                    pipe.close()
+            raise
+        finally:
+            theirs.close()
+            for fd in to_close:
+                os.close(fd)
+
+        if error is not None:
+            conn.close()
+            for pipe in pipes:
+                if pipe is not None:
+                    pipe.close()
+            raise error
+        return LaunchedProcess(args, pid, conn, *pipes)
+
+
+class LaunchedProcess:
+    '''
+    A command started by a `Launcher`.
+
+    This has the attributes and methods of `subprocess.Popen` that
+    pysh uses, with the same meanings; plus `rusage`, the command's
+    resource usage as from `os.wait4`, once it has exited.
+    '''
+
+    def __init__(self, args, pid: int, conn: socket.socket,
+                 stdin, stdout, stderr) -> None:
+        self.args = args
+        self.pid = pid
+        self.conn = conn
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        self.rusage = None
+        self.wait_lock = threading.Lock()
+        # Held to use `conn` for a signal, or to close it.
+        self.conn_lock = threading.Lock()
+        self.communication = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        # Compare `subprocess.Popen.__exit__`.
+        for f in (self.stdout, self.stderr):
+            if f is not None:
+                f.close()
+        try:
+            if self.stdin is not None:
+                self.stdin.close()
+        except BrokenPipeError:
+            pass
+        finally:
+            self.wait()
+
+    def poll(self):
+        self.wait_status(0)
+        return self.returncode
+
+    def wait(self, timeout=None) -> int:
+        if not self.wait_status(timeout):
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return self.returncode
+
+    def wait_status(self, timeout) -> bool:
+        '''Wait for the launcher to report the command exited, or time out.'''
+        with self.wait_lock:
+            if self.returncode is not None:
+                return True
+            self.conn.settimeout(timeout)
+            try:
+                self.conn.recv(1, socket.MSG_PEEK)
+            except (BlockingIOError, socket.timeout):
+                return False
+            finally:
+                self.conn.settimeout(None)
+            try:
+                self.returncode, self.rusage = recv_obj(self.conn)
+            except EOFError:
+                raise ChildProcessError(
+                    'pysh launcher exited while running: {}'.format(self.args))
+            with self.conn_lock:
+                self.conn.close()
+            return True
+
+    def send_signal(self, sig: int) -> None:
+        # The command is the launcher's child, not ours; once it exits,
+        # the launcher may reap it before telling us, and its pid be
+        # reused.  So the launcher signals it, only if not yet reaped.
+        with self.conn_lock:
+            if self.returncode is not None or self.conn.fileno() < 0:
+                return
+            try:
+                send_obj(self.conn, sig)
+            except OSError:
+                pass  # Already exited and reported, or the launcher died.
+
+    def terminate(self) -> None:
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self) -> None:
+        self.send_signal(signal.SIGKILL)
+
+    def communicate(self, input=None, timeout=None):
+        '''Just like `subprocess.Popen.communicate`.'''
+        # Compare Popen._communicate, in cpython:Lib/subprocess.py.
+        # After a timeout, a later call picks up where this one left off.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self.communication is None:
+            self.communication = Communication(self, input)
+        comm = self.communication
+        while comm.selector.get_map():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(self.args, timeout)
+            for key, _ in comm.selector.select(remaining):
+                comm.ready(key.fileobj)
+        comm.selector.close()
+
+        remaining = (None if deadline is None
+                     else max(0, deadline - time.monotonic()))
+        if not self.wait_status(remaining):
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return (b''.join(comm.output[1]) if self.stdout is not None else None,
+                b''.join(comm.output[2]) if self.stderr is not None else None)
+
+
+class Communication:
+    '''The state of an ongoing `LaunchedProcess.communicate`.'''
+
+    def __init__(self, proc: LaunchedProcess, input) -> None:
+        self.selector = selectors.DefaultSelector()
+        self.output = {1: [], 2: []}
+        self.files = {}
+        self.input = memoryview(input or b'')
+        if proc.stdin is not None:
+            proc.stdin.flush()
+            if self.input:
+                os.set_blocking(proc.stdin.fileno(), False)
+                self.register(proc.stdin, 0, selectors.EVENT_WRITE)
+            else:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+        for std_fd, f in ((1, proc.stdout), (2, proc.stderr)):
+            if f is not None:
+                self.register(f, std_fd, selectors.EVENT_READ)
+
+    def register(self, f, std_fd: int, events) -> None:
+        self.files[f.fileno()] = (f, std_fd)
+        self.selector.register(f.fileno(), events)
+
+    def done(self, fd: int) -> None:
+        self.selector.unregister(fd)
+        f, _ = self.files.pop(fd)
+        try:
+            f.close()
+        except BrokenPipeError:
+            pass
+
+    def ready(self, fd: int) -> None:
+        _, std_fd = self.files[fd]
+        if std_fd == 0:
+            try:
+                self.input = self.input[os.write(fd, self.input):]
+            except BlockingIOError:
+                return
+            except BrokenPipeError:
+                self.input = memoryview(b'')
+            if not self.input:
+                self.done(fd)
+            return
+        chunk = os.read(fd, 65536)
+        if chunk:
+            self.output[std_fd].append(chunk)
+        else:
+            self.done(fd)
+
+
+current = None  # type: Launcher
+
+
+def start() -> Launcher:
+    '''
+    Start the launcher, if not already running, for all commands to use.
+
+    Call this early: ideally before the process has grown, and before
+    it has any other threads.
+    '''
+    global current
+    if current is None or current.closed:
+        current = Launcher()
+    return current
+
+
+def stop() -> None:
+    '''Stop the launcher, if running; commands are then started directly.'''
+    global current
+    if current is not None:
+        current.close()
+        current = None
+
+
+if __name__ == '__main__':
+    serve(socket.socket(fileno=int(sys.argv[1])))
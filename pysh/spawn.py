@@ -0,0 +1,209 @@
+'''
+Starting external commands, with :func:`os.posix_spawn` where possible.
+
+The functions in pysh that run an external command, like
+`.check_cmd()`, `.slurp_cmd()`, and `.cmd.run`, start it with `popen`
+here.  That gives a :class:`subprocess.Popen` just as usual, but tries
+to have it started by ``posix_spawn`` rather than by ``fork``.
+
+The exceptions are `.check_cmd_f()`, `.try_cmd_f()`, `.slurp_cmd_f()`,
+and `.try_slurp_cmd_f()`, which pass any keyword arguments through to
+:mod:`subprocess`, and so call it directly; and everything in
+`pysh.asyncio`, which uses :mod:`asyncio`'s own subprocess support.
+
+The difference matters for a parent process with a big heap: ``fork``
+(unless done as ``vfork``) takes time in proportion to the parent's
+memory, while ``posix_spawn`` is implemented with ``vfork`` or an
+equivalent, and takes about the same time whatever the parent's size.
+
+:mod:`subprocess` itself uses ``posix_spawn`` on suitable platforms
+(Python 3.8+ on macOS, or on Linux with glibc 2.24+), but only for a
+narrow set of options, which its defaults fall outside of.  So we
+arrange the options to fit:
+
+* We pass ``close_fds=False``.  This is safe because Python opens all
+  its files non-inheritable (PEP 446); only a file descriptor someone
+  has explicitly made inheritable, with :func:`os.set_inheritable`,
+  would leak to the command.  If that's a concern, set `enabled` to
+  false.
+
+* We look up the command in ``PATH`` ourselves, as ``posix_spawn``
+  wants a path.
+
+* A redirection to one of the standard file descriptors 0, 1, or 2
+  is passed instead as a duplicate of that file descriptor.
+
+* A *cwd* is handled by a tiny helper: ``/bin/sh`` changes directory
+  and then replaces itself with the command, at the cost of an extra
+  ``exec``.
+
+All that is worthwhile only where the alternative is a real ``fork``.
+On Linux since Python 3.10, the normal path in :class:`subprocess.Popen`
+uses ``vfork`` itself for all the options pysh passes; it's at least as
+fast, and keeps ``close_fds``.  So there, and in any other case
+including a command to start in a new process group, we take that
+normal path.  Which path each command took is counted in `counts`,
+and recorded on the `trace.StageStats` when instrumenting.
+
+If a `.launcher` is running, it starts every command that comes here
+instead.
+'''
+
+import collections
+import os
+import shutil
+import subprocess
+import sys
+from typing import List, Optional
+
+#: Whether to use ``posix_spawn`` where possible.
+enabled = True
+
+#: How many commands were started by each method: ``'launcher'`` if
+#: by `.launcher`; ``'posix_spawn'``; or for the normal path in
+#: :class:`subprocess.Popen`, ``'vfork'`` or ``'fork'`` according to
+#: what it does.
+counts = collections.Counter()  # type: collections.Counter
+
+SHELL = '/bin/sh'
+
+# Change to the directory "$0", then run the command "$@" in our place.
+CD_HELPER = 'cd -- "$0" && exec "$@"'
+
+
+def supported() -> bool:
+    '''Whether `subprocess` can start commands with ``posix_spawn`` here.'''
+    # This is private to `subprocess`, but stable since it was added in
+    # Python 3.8; before that, there's no such path, and it's absent.
+    return getattr(subprocess, '_USE_POSIX_SPAWN', False)
+
+
+def popen_method() -> str:
+    '''How :class:`subprocess.Popen` starts commands, when not by posix_spawn.'''
+    # Since Python 3.10, on Linux it uses vfork when there's no
+    # preexec_fn and no change of user or group -- so for all of ours.
+    if sys.platform == 'linux' and sys.version_info >= (3, 10):
+        return 'vfork'
+    return 'fork'
+
+
+def resolve(program: str, cwd: Optional[str]) -> Optional[str]:
+    '''The path of the executable for `program`, or None if none is found.'''
+    if os.path.dirname(program):
+        path = program if cwd is None else os.path.join(cwd, program)
+        return path if is_executable(path) else None
+    return shutil.which(program)
+
+
+def is_executable(path: str) -> bool:
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+
+def std_fd(target) -> Optional[int]:
+    '''The file descriptor for a redirection `target`, if it's 0, 1, or 2.'''
+    # Special values like `subprocess.PIPE` are negative.
+    if isinstance(target, int):
+        fd = target
+    elif target is None:
+        return None
+    else:
+        fd = target.fileno()
+    return fd if 0 <= fd <= 2 else None
+
+
+def group_options(new_group: bool) -> dict:
+    '''Options for :class:`subprocess.Popen` to start a new process group.'''
+    if not new_group:
+        return {}
+    if sys.version_info >= (3, 11):
+        return dict(process_group=0)
+    # py310: no `process_group`; a new session is a new group too.
+    return dict(start_new_session=True)
+
+
+def popen(cmd: List[str], *, stdin=None, stdout=None, stderr=None,
+          cwd: Optional[str] = None,
+          new_group: bool = False) -> subprocess.Popen:
+    '''
+    Start `cmd`, just like :class:`subprocess.Popen` with these arguments.
+
+    If *new_group* is true, the command is the leader of a new process
+    group, so that it can be signalled along with any processes it
+    starts; as for `.deadline`.
+
+    The command is started with ``posix_spawn`` if possible; which
+    way was used is counted in `counts`, and is the resulting object's
+    attribute ``spawn_method``.  Its attribute ``new_group`` is
+    *new_group*.
+    '''
+    options = group_options(new_group)
+
+    # Only if `.launcher` is imported can it have been started.
+    launcher = sys.modules.get(__package__ + '.launcher')
+    if launcher is not None and launcher.current is not None:
+        try:
+            proc = launcher.current.launch(
+                cmd, stdin=stdin, stdout=stdout, stderr=stderr, cwd=cwd,
+                **options)
+        except launcher.Unavailable:
+            pass  # Start it ourselves, below.
+        else:
+            proc.spawn_method = 'launcher'
+            proc.new_group = new_group
+            counts['launcher'] += 1
+            return proc
+
+    executable = None
+    # Where `subprocess` uses vfork, it's as fast as `posix_spawn`, and
+    # keeps ``close_fds``; so rearranging the options only costs time.
+    # And it takes the `posix_spawn` path only with no new group.
+    if (enabled and supported() and popen_method() == 'fork'
+            and cmd and not options):
+        executable = resolve(cmd[0], cwd)
+        if cwd is not None and not (
+                # Let `subprocess` report any error in the usual way.
+                os.path.isdir(cwd) and is_executable(SHELL)):
+            executable = None
+    if executable is None:
+        proc = subprocess.Popen(
+            cmd, stdin=stdin, stdout=stdout, stderr=stderr, cwd=cwd,
+            **options)
+        proc.spawn_method = popen_method()
+        proc.new_group = new_group
+        counts[proc.spawn_method] += 1
+        return proc
+
+    # `posix_spawn` is skipped for any redirection to a standard file
+    # descriptor, as it would have to be done in a special order.
+    # The same file, on a descriptor of its own, works just as well.
+    if stderr == subprocess.STDOUT and stdout is None:
+        # That means our own stdout.
+        stderr = 1
+    dups = []
+    redirects = []
+    for target in (stdin, stdout, stderr):
+        fd = std_fd(target)
+        if fd is not None:
+            target = os.dup(fd)
+            dups.append(target)
+        redirects.append(target)
+    stdin, stdout, stderr = redirects
+
+    if cwd is not None:
+        args = [SHELL, '-c', CD_HELPER, cwd] + list(cmd)
+        executable = SHELL
+    else:
+        args = cmd
+    try:
+        proc = subprocess.Popen(
+            args, executable=executable, close_fds=False,
+            stdin=stdin, stdout=stdout, stderr=stderr)
+    finally:
+        for fd in dups:
+            os.close(fd)
+    # As for `subprocess.Popen`, e.g. for `subprocess.CalledProcessError`.
+    proc.args = cmd
+    proc.spawn_method = 'posix_spawn'
+    proc.new_group = False
+    counts['posix_spawn'] += 1
+    return proc
@@ -30,11 +30,30 @@ In short, these functions fill the following table::
 
     slurp_cmd      try_slurp_cmd
     slurp_cmd_f    try_slurp_cmd_f
+
+To avoid running the same command again and again for the same
+output, `.cached` remembers the results of `.slurp_cmd()` or
+`.try_slurp_cmd()`.  For a command that can answer a series of
+requests itself, like ``git cat-file --batch``, `.coproc` keeps it
+running and sends it one request after another.
+
+Finally, `.map_cmd()` runs the same command for each item of an
+iterable, several at a time, and produces the output of each like
+`.slurp_cmd()`.  Its variants `.try_map_cmd()` and `.check_map_cmd()`
+relate to it like `.try_slurp_cmd()` and `.check_cmd()` to `.slurp_cmd()`.
 '''
 
+import collections
+from concurrent import futures
+import os
+import queue
 import subprocess
-from typing import Optional
+import threading
+import time
+from typing import Callable, Iterable, Iterator, List, Optional
 
+from . import deadline, spawn
+from .filters import read_stripped
 from .words import caller_namespace, shwords
 
 
@@ -69,14 +88,17 @@ def check_cmd(fmt, *args,
     The named keyword arguments are passed through, with ``stdin=_stdin`` etc.
     All other arguments are passed to `.shwords()`.
     '''
-    subprocess.check_call(
-        shwords(fmt, *args, **kwargs),
-        stdin=_stdin,
-        stdout=_stdout,
-        stderr=_stderr,
-        cwd=_cwd,
-        timeout=_timeout,
-    )
+    cmd = shwords(fmt, *args, **kwargs)
+    # Compare subprocess.call, in cpython:Lib/subprocess.py.
+    with spawn.popen(cmd, stdin=_stdin, stdout=_stdout, stderr=_stderr,
+                     cwd=_cwd) as proc:
+        try:
+            retcode = proc.wait(timeout=_timeout)
+        except BaseException:
+            proc.kill()
+            raise
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, cmd)
 
 
 def check_cmd_f(fmt, **kwargs) -> None:
@@ -123,7 +145,7 @@ def try_cmd_f(fmt, **kwargs) -> bool:
 
 def slurp_cmd(fmt, *args,
               _stdin=None, _stderr=None,
-              _cwd=None, _timeout=None,
+              _cwd=None, _timeout=None, _spill=None,
               **kwargs) -> str:
     '''
     Run the command and capture output, stripping any trailing newlines.
@@ -131,19 +153,65 @@ def slurp_cmd(fmt, *args,
     Stripping trailing newlines is the same behavior as ``$(...)`` has
     in Bash.  It fits nicely with conventional semantics for Unix CLI tools.
 
+    If *_spill* is given, output larger than that many bytes goes to
+    a temporary file instead of memory, just like the *spill*
+    argument of `pysh.slurp()`.
+
     See also `pysh.slurp()`.
     '''
     # For reference on `$(...)` see Bash manual, 3.5.4 Command Substitution.
-    raw_output = subprocess.check_output(
-        shwords(fmt, *args, **kwargs),
-        stdin=_stdin,
-        stderr=_stderr,
-        cwd=_cwd,
-        timeout=_timeout,
-    )
+    cmd = shwords(fmt, *args, **kwargs)
+    if _spill is not None:
+        return slurp_spilled(cmd, _spill, stdin=_stdin, stderr=_stderr,
+                             cwd=_cwd, timeout=_timeout)
+    # Compare subprocess.run, in cpython:Lib/subprocess.py.
+    with spawn.popen(cmd, stdin=_stdin, stdout=subprocess.PIPE,
+                     stderr=_stderr, cwd=_cwd) as proc:
+        try:
+            raw_output, _ = proc.communicate(timeout=_timeout)
+        except subprocess.TimeoutExpired as e:
+            proc.kill()
+            e.output, _ = proc.communicate()
+            raise
+        except BaseException:
+            proc.kill()
+            raise
+    if proc.returncode:
+        raise subprocess.CalledProcessError(
+            proc.returncode, cmd, output=raw_output)
     return raw_output.rstrip(b'\n')
 
 
+def slurp_spilled(cmd, spill, *, stdin, stderr, cwd, timeout):
+    # Compare subprocess.run, in cpython:Lib/subprocess.py.
+    with spawn.popen(cmd, stdin=stdin, stdout=subprocess.PIPE,
+                     stderr=stderr, cwd=cwd) as proc:
+        # The output can't all be in memory for `communicate` to time
+        # out while reading it; so use a timer to kill the command.
+        timer = None
+        timed_out = threading.Event()
+        if timeout is not None:
+            def expire():
+                timed_out.set()
+                proc.kill()
+            timer = threading.Timer(timeout, expire)
+            timer.start()
+        try:
+            output = read_stripped(proc.stdout, spill)
+            retcode = proc.wait()
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, cmd)
+    return output
+
+
 def slurp_cmd_f(fmt, **kwargs) -> str:
     '''
     Just like `.slurp_cmd()`, but with `.shwords_f()` instead of `.shwords()`.
@@ -181,3 +249,439 @@ def try_slurp_cmd_f(fmt, **kwargs) -> Optional[str]:
         return raw_output.rstrip(b'\n')
     except subprocess.CalledProcessError:
         return None
+
+
+class cached:
+    '''
+    A memoizing version of `.slurp_cmd()`, or of `.try_slurp_cmd()`.
+
+    For commands that are run over and over for the same answer:
+
+    >>> slurp = cached(ttl=60)
+    >>> slurp('git rev-parse --show-toplevel')  # runs git
+    b'/home/user/src/pysh'
+    >>> slurp('git rev-parse --show-toplevel')  # just remembers
+
+    The call is just like *func*, by default `.slurp_cmd()`.  Results
+    are keyed on the command line, the working directory, *_stderr*
+    and any other options like *_spill*, and the values of the
+    environment variables named in *env*.  A call with *_stdin* is
+    never cached.  For `.slurp_cmd()`, failures
+    aren't cached; for `.try_slurp_cmd()`, the `None` for a failure is.
+
+    A result is forgotten after *ttl* seconds, if given; or if any of
+    the files *paths* changes, as seen from its modification time.
+    At most *maxsize* results are kept, dropping the least recently
+    used.  The counts of calls answered from the cache, and not, are
+    in `hits` and `misses`.
+    '''
+
+    def __init__(self, func=None, *, ttl: Optional[float] = None,
+                 maxsize: Optional[int] = 128,
+                 env: Iterable[str] = (), paths: Iterable[str] = ()) -> None:
+        self.func = slurp_cmd if func is None else func
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.env = tuple(env)
+        self.paths = tuple(paths)
+        self.hits = 0
+        self.misses = 0
+        # key -> (expiry time, file mtimes, result), least recent first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __call__(self, fmt, *args, _stdin=None, _stderr=None, _cwd=None,
+                 **kwargs):
+        if _stdin is not None:
+            return self.func(fmt, *args, _stdin=_stdin, _stderr=_stderr,
+                             _cwd=_cwd, **kwargs)
+        words_kwargs = {name: value for name, value in kwargs.items()
+                        if not name.startswith('_')}
+        # Other options, like *_spill*, may change the result.
+        options = sorted((name, value) for name, value in kwargs.items()
+                         if name.startswith('_'))
+        key = (
+            tuple(shwords(fmt, *args, **words_kwargs)),
+            os.path.abspath(_cwd if _cwd is not None else os.curdir),
+            _stderr,
+            tuple(options),
+            tuple(os.environ.get(name) for name in self.env),
+        )
+        now = time.monotonic()
+        mtimes = self.mtimes()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expiry, entry_mtimes, result = entry
+                if (expiry is None or now < expiry) and entry_mtimes == mtimes:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+                del self.entries[key]
+            self.misses += 1
+
+        result = self.func(fmt, *args, _stderr=_stderr, _cwd=_cwd, **kwargs)
+
+        expiry = None if self.ttl is None else now + self.ttl
+        with self.lock:
+            self.entries[key] = (expiry, mtimes, result)
+            self.entries.move_to_end(key)
+            if self.maxsize is not None:
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        return result
+
+    def mtimes(self) -> tuple:
+        result = []
+        for path in self.paths:
+            try:
+                result.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                result.append(None)
+        return tuple(result)
+
+    def clear(self) -> None:
+        '''Forget all results.  The counts `hits` and `misses` remain.'''
+        with self.lock:
+            self.entries.clear()
+
+
+class coproc:
+    '''
+    A command kept running, to answer requests one at a time.
+
+    Many tools answer a series of queries read from their stdin, each
+    with a response on stdout; like ``git cat-file --batch-check`` or
+    ``git check-attr --stdin``.  Rather than starting the command anew
+    for each query, start it once:
+
+    >>> objects = coproc('git cat-file --batch-check')
+    >>> objects.request(b'HEAD')
+    b'a4d9b0c2c7a1... commit 271'
+    >>> objects.request(b'HEAD:README.md')
+    b'5d01d4c0e8f8... blob 2209'
+    >>> objects.close()
+
+    The arguments *fmt*, *\\*args*, and *\\*\\*kwargs* are as for
+    `.shwords()`, and *_stderr* and *_cwd* as for `.check_cmd()`.
+
+    The *_framing* says how requests and responses are delimited:
+
+    * ``'line'``, the default: each request is sent followed by a
+      newline, and each response is a line; the result omits the
+      newline.
+    * ``'nul'``: the same, with a NUL byte ``b'\\0'`` instead.
+    * ``'length'``: each request is sent after its length, as 4 bytes
+      big-endian, and each response is read the same way.
+    * A function: it's called with the command's stdout, and reads
+      and returns one response.  Requests are sent just as given.
+
+    Each request is written in full before its response is read; so
+    a request much longer than a pipe buffer (typically 64 KiB) may
+    deadlock with a command that starts responding before it's done
+    reading.
+
+    Requests may come from any number of threads.  With *_jobs* above
+    1, up to that many copies of the command are run, as needed, each
+    answering one request at a time.  If a copy of the command exits,
+    its request fails with :class:`subprocess.CalledProcessError`, or
+    if its status is zero, :class:`EOFError`; the next request starts
+    a fresh copy.
+
+    Use as a context manager, or call `close` when done, to close the
+    commands' input and wait for them to exit.
+    '''
+
+    def __init__(self, fmt: str, *args, _framing='line', _jobs: int = 1,
+                 _stderr=None, _cwd=None, **kwargs) -> None:
+        self.cmd = shwords(fmt, *args, **kwargs)
+        if callable(_framing):
+            self.read_response = _framing
+            self.frame_request = lambda request: request
+        elif _framing in ('line', 'nul'):
+            delim = b'\n' if _framing == 'line' else b'\0'
+            self.read_response = lambda f: read_until(f, delim)
+            self.frame_request = lambda request: request + delim
+        elif _framing == 'length':
+            self.read_response = read_length_prefixed
+            self.frame_request = \
+                lambda request: len(request).to_bytes(4, 'big') + request
+        else:
+            raise ValueError('bad framing: {!r}'.format(_framing))
+        self.jobs = _jobs
+        self.stderr = _stderr
+        self.cwd = _cwd
+
+        self.lock = threading.Lock()
+        self.procs = set()  # type: set
+        self.closed = False
+        # For each of `jobs` slots, an idle command, or None for a slot
+        # with none running yet.  Last in, first out: a command that's
+        # already warm is reused before another is started.
+        self.idle = queue.LifoQueue()  # type: queue.LifoQueue
+        for _ in range(_jobs):
+            self.idle.put(None)
+
+    def request(self, request: bytes) -> bytes:
+        '''Send `request` to the command, and return its response.'''
+        if self.closed:
+            raise ValueError('coproc is closed')
+        proc = self.idle.get()
+        try:
+            if proc is None:
+                proc = self.start()
+            try:
+                proc.stdin.write(self.frame_request(request))
+                proc.stdin.flush()
+                response = self.read_response(proc.stdout)
+            except (BrokenPipeError, EOFError):
+                self.stop(proc)
+                if proc.returncode:
+                    raise subprocess.CalledProcessError(
+                        proc.returncode, self.cmd) from None
+                raise EOFError(
+                    'coprocess exited: {!r}'.format(self.cmd)) from None
+            except BaseException:
+                # It may be partway through a response; don't reuse it.
+                proc.kill()
+                self.stop(proc)
+                raise
+        except BaseException:
+            self.idle.put(None)
+            raise
+        self.idle.put(proc)
+        return response
+
+    def start(self):
+        with self.lock:
+            if self.closed:
+                raise ValueError('coproc is closed')
+            proc = spawn.popen(
+                self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=self.stderr, cwd=self.cwd)
+            self.procs.add(proc)
+        return proc
+
+    def stop(self, proc) -> None:
+        with self.lock:
+            self.procs.discard(proc)
+        for f in (proc.stdin, proc.stdout):
+            try:
+                f.close()
+            except BrokenPipeError:
+                pass  # Unflushed input; but it's exited anyway.
+        proc.wait()
+
+    def close(self) -> None:
+        '''Close the commands' input, and wait for them to exit.'''
+        with self.lock:
+            self.closed = True
+            procs = list(self.procs)
+        for proc in procs:
+            self.stop(proc)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, value, traceback) -> None:
+        self.close()
+
+
+def read_until(f, delim: bytes) -> bytes:
+    '''Read from `f` through the next `delim`, and return what precedes it.'''
+    if delim == b'\n':
+        line = f.readline()
+        if not line.endswith(delim):
+            raise EOFError()
+        return line[:-1]
+    parts = []
+    while True:
+        buffered = f.peek()
+        if not buffered:
+            raise EOFError()
+        end = buffered.find(delim)
+        if end >= 0:
+            parts.append(f.read(end + 1)[:-1])
+            return b''.join(parts)
+        parts.append(f.read(len(buffered)))
+
+
+def read_length_prefixed(f) -> bytes:
+    header = f.read(4)
+    if len(header) < 4:
+        raise EOFError()
+    length = int.from_bytes(header, 'big')
+    data = f.read(length)
+    if len(data) < length:
+        raise EOFError()
+    return data
+
+
+class CmdPool:
+    '''
+    Runs a command for each of a series of items, several at a time.
+
+    The command line for each item is `command(item)`.  This is the
+    implementation of `.map_cmd()` and its relatives, and of `.cmd.xargs`.
+    '''
+
+    def __init__(self, command: Callable[..., List], *, jobs, capture, check,
+                 stdin, stdout, stderr, cwd, timeout, strip=True) -> None:
+        self.command = command
+        self.jobs = jobs or os.cpu_count() or 1
+        self.capture = capture
+        self.strip = strip
+        self.check = check
+        self.popen_kwargs = dict(
+            stdin=stdin,
+            stdout=subprocess.PIPE if capture else stdout,
+            stderr=stderr,
+            cwd=cwd,
+        )
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.running = set()
+        self.stopping = False
+
+    def run_one(self, item):
+        cmd = self.command(item)
+        with spawn.popen(cmd, new_group=deadline.new_group(),
+                         **self.popen_kwargs) as proc, \
+                deadline.watching(proc):
+            with self.lock:
+                self.running.add(proc)
+                if self.stopping:
+                    proc.kill()
+            try:
+                output, _ = proc.communicate(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+                raise
+            finally:
+                with self.lock:
+                    self.running.discard(proc)
+        if proc.returncode:
+            if self.check:
+                raise subprocess.CalledProcessError(
+                    proc.returncode, cmd, output=output)
+            return None
+        if not self.capture:
+            return None
+        return output.rstrip(b'\n') if self.strip else output
+
+    def stop(self) -> None:
+        '''Kill any commands in flight, and start no more.'''
+        with self.lock:
+            self.stopping = True
+            for proc in self.running:
+                proc.kill()
+
+    def map(self, iterable: Iterable, ordered: bool) -> Iterator:
+        items = iter(iterable)
+        # Futures for items started, in order, and not yet yielded.
+        pending = collections.OrderedDict()
+        run_one = deadline.inherit(self.run_one)
+        with futures.ThreadPoolExecutor(self.jobs) as executor:
+            try:
+                while True:
+                    # Keep `jobs` many commands in flight.  If an early
+                    # one is slow, let later results queue up behind it,
+                    # but only so far.
+                    while len(pending) < 4 * self.jobs:
+                        in_flight = sum(not f.done() for f in pending)
+                        if in_flight >= self.jobs:
+                            break
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            break
+                        pending[executor.submit(run_one, item)] = item
+                    if not pending:
+                        return
+
+                    done, _ = futures.wait(
+                        pending, return_when=futures.FIRST_COMPLETED)
+                    for future in done:
+                        # Raise any failure right away, even if ordered.
+                        future.result()
+                    if ordered:
+                        while pending:
+                            future = next(iter(pending))
+                            if not future.done():
+                                break
+                            del pending[future]
+                            yield future.result()
+                    else:
+                        for future in done:
+                            yield pending.pop(future), future.result()
+            finally:
+                self.stop()
+                for future in pending:
+                    future.cancel()
+
+
+def map_cmd(fmt, iterable: Iterable, *,
+            _jobs=None, _ordered=True,
+            _stdin=None, _stderr=None,
+            _cwd=None, _timeout=None,
+            **kwargs) -> Iterator:
+    '''
+    Like `.slurp_cmd()` for each item of *iterable*, running in parallel.
+
+    Each item is passed to `.shwords()` as the one positional argument,
+    along with any *kwargs*.  For example:
+
+    >>> list(map_cmd('echo {} {sep}', ['a', 'b'], sep='.'))
+    [b'a .', b'b .']
+
+    Up to *_jobs* many commands run at once, by default one per CPU.
+    Results come in the same order as *iterable*; or if *_ordered* is
+    false, as soon as each command completes, as pairs
+    ``(item, output)``.
+
+    If a command fails, the commands still running are killed, no more
+    are started, and the `subprocess.CalledProcessError` is raised.
+    The other named keyword arguments apply to each command, as for
+    `.slurp_cmd()`.
+    '''
+    pool = CmdPool(lambda item: shwords(fmt, item, **kwargs),
+                   jobs=_jobs, capture=True, check=True,
+                   stdin=_stdin, stdout=None, stderr=_stderr,
+                   cwd=_cwd, timeout=_timeout)
+    return pool.map(iterable, _ordered)
+
+
+def try_map_cmd(fmt, iterable: Iterable, *,
+                _jobs=None, _ordered=True,
+                _stdin=None, _stderr=None,
+                _cwd=None, _timeout=None,
+                **kwargs) -> Iterator:
+    '''
+    Just like `.map_cmd()`, but gives `None` for failures rather than raise.
+    '''
+    pool = CmdPool(lambda item: shwords(fmt, item, **kwargs),
+                   jobs=_jobs, capture=True, check=False,
+                   stdin=_stdin, stdout=None, stderr=_stderr,
+                   cwd=_cwd, timeout=_timeout)
+    return pool.map(iterable, _ordered)
+
+
+def check_map_cmd(fmt, iterable: Iterable, *,
+                  _jobs=None,
+                  _stdin=None, _stdout=None, _stderr=None,
+                  _cwd=None, _timeout=None,
+                  **kwargs) -> None:
+    '''
+    Like `.check_cmd()` for each item of *iterable*, running in parallel.
+
+    Just like `.map_cmd()`, but the commands' output is not captured,
+    and this returns once all the commands have succeeded.
+    '''
+    pool = CmdPool(lambda item: shwords(fmt, item, **kwargs),
+                   jobs=_jobs, capture=False, check=True,
+                   stdin=_stdin, stdout=_stdout, stderr=_stderr,
+                   cwd=_cwd, timeout=_timeout)
+    for _ in pool.map(iterable, ordered=False):
+        pass
@@ -0,0 +1,382 @@
+'''
+Opt-in instrumentation of pipelines, stage by stage.
+
+Within ``with trace.instrument(callback):``, each pipeline stage that
+runs, in any thread, is measured; when it finishes, `callback` is
+called with a `StageStats` describing it.  For example, to find out
+which stage of a slow pipeline is responsible:
+
+>>> with trace.instrument(print):
+...     pysh.slurp(cmd.run('seq 100000') | cmd.splitlines() | cmd.joinlines())
+<StageStats run('seq 100000'): 0.117s, bytes 0 in, None out, cpu 0.002s user 0.000s sys, max RSS 2092 KiB>
+<StageStats splitlines(): 0.139s, bytes 588895 in, 100000 out>
+<StageStats joinlines(): 0.140s, bytes 100000 in, 588895 out>
+
+The built-in `chrome_trace` writes the same information as a Chrome
+trace-event JSON file, which trace viewers like ``chrome://tracing``
+or Perfetto can show as a timeline.
+
+Data that Python hands to an external command as a file descriptor,
+rather than reading or writing itself, isn't seen by Python, and so
+isn't counted; the corresponding counts are None.  Stages running
+natively under asyncio (see `pysh.asyncio`) are not instrumented.
+'''
+
+import io
+import os
+import sys
+import threading
+import time
+from typing import Callable, List, Optional
+
+
+# The active callbacks.  Replaced rather than mutated, so readers
+# needn't take the lock.
+listeners = ()  # type: tuple
+listeners_lock = threading.Lock()
+
+local = threading.local()
+
+
+class instrument:
+    '''
+    Context manager: call *callback* with a `StageStats` for each stage run.
+
+    This applies to pipeline stages run in any thread, while the
+    context is active.  Contexts may be nested, or overlap; each
+    active callback is called for each stage.
+    '''
+
+    def __init__(self, callback: Callable[['StageStats'], None]) -> None:
+        self.callback = callback
+
+    def __enter__(self):
+        global listeners
+        with listeners_lock:
+            listeners = listeners + (self.callback,)
+        return self.callback
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        global listeners
+        with listeners_lock:
+            items = list(listeners)
+            items.remove(self.callback)
+            listeners = tuple(items)
+
+
+class StageStats:
+    '''Measurements of one pipeline stage, as passed to `instrument` callbacks.'''
+
+    name: str
+    thread: int  # as from `threading.get_ident`
+
+    # As from `time.perf_counter`.
+    start: float
+    end: float
+
+    # Data the stage read and wrote, in bytes (or characters, for text
+    # streams, or items, for iterators), and in how many calls.  None
+    # where the data went by file descriptor, unseen.
+    bytes_in: Optional[int]
+    bytes_out: Optional[int]
+    chunks_in: Optional[int]
+    chunks_out: Optional[int]
+
+    # For a stage running an external command, like `.cmd.run`:
+    argv: Optional[List[str]]
+    pid: Optional[int]
+    returncode: Optional[int]
+    user_time: Optional[float]  # CPU seconds, as from `os.wait4`
+    system_time: Optional[float]
+    max_rss_kib: Optional[int]
+    spawn_method: Optional[str]  # as from `.spawn.popen`
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = None
+        self.bytes_in = self.bytes_out = None
+        self.chunks_in = self.chunks_out = None
+        self.argv = self.pid = self.returncode = None
+        self.user_time = self.system_time = self.max_rss_kib = None
+        self.spawn_method = None
+
+    @property
+    def seconds(self) -> float:
+        '''Wall-clock time the stage took.'''
+        return self.end - self.start
+
+    def __repr__(self) -> str:
+        return '<StageStats {}: {:.3f}s, bytes {} in, {} out{}>'.format(
+            self.name, self.seconds, self.bytes_in, self.bytes_out,
+            '' if self.pid is None else
+            ', cpu {:.3f}s user {:.3f}s sys, max RSS {} KiB'.format(
+                self.user_time, self.system_time, self.max_rss_kib))
+
+
+def current_stage() -> Optional[StageStats]:
+    '''The stage being measured in this thread, if any.'''
+    return getattr(local, 'stage', None)
+
+
+def wait(proc) -> int:
+    '''
+    Wait for *proc*, as from `.spawn.popen`, and return its return code.
+
+    If a stage is being measured in this thread, the command's
+    resource usage is recorded on it too.
+    '''
+    stage = current_stage()
+    if stage is None:
+        return proc.wait()
+    if hasattr(proc, 'rusage'):
+        # Started by `.launcher`, which waited for it for us.
+        proc.wait()
+        rusage = proc.rusage
+    else:
+        _, status, rusage = os.wait4(proc.pid, 0)
+        # py38: os.waitstatus_to_exitcode is new in Python 3.9.
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+    stage.argv = proc.args
+    stage.pid = proc.pid
+    stage.returncode = proc.returncode
+    stage.spawn_method = getattr(proc, 'spawn_method', None)
+    stage.user_time = rusage.ru_utime
+    stage.system_time = rusage.ru_stime
+    # ru_maxrss is in KiB on Linux, but bytes on macOS.
+    stage.max_rss_kib = (rusage.ru_maxrss // 1024 if sys.platform == 'darwin'
+                         else rusage.ru_maxrss)
+    return proc.returncode
+
+
+class Counter:
+    '''Counts the data passing through one of a stage's inputs or outputs.'''
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.calls = 0
+        self.by_fd = False
+
+    def add(self, data):
+        if data:
+            self.count += len(data)
+            self.calls += 1
+        return data
+
+
+class CountingStream(io.BufferedIOBase):
+    '''A binary stream proxy, counting what's read or written.'''
+
+    def __init__(self, stream, counter: Counter) -> None:
+        self.stream = stream
+        self.counter = counter
+
+    def __del__(self):
+        # Unlike other streams, don't close when garbage-collected;
+        # the underlying stream belongs to someone else.
+        pass
+
+    def fileno(self):
+        fd = self.stream.fileno()
+        self.counter.by_fd = True
+        return fd
+
+    def readable(self):
+        return self.stream.readable()
+
+    def writable(self):
+        return self.stream.writable()
+
+    @property
+    def closed(self):
+        return self.stream.closed
+
+    def close(self):
+        self.stream.close()
+
+    def flush(self):
+        self.stream.flush()
+
+    def read(self, size=-1):
+        return self.counter.add(self.stream.read(size))
+
+    def read1(self, size=-1):
+        return self.counter.add(self.stream.read1(size))
+
+    def readline(self, size=-1):
+        return self.counter.add(self.stream.readline(size))
+
+    def readinto(self, b):
+        count = self.stream.readinto(b)
+        if count:
+            self.counter.add(memoryview(b)[:count])
+        return count
+
+    def readinto1(self, b):
+        count = self.stream.readinto1(b)
+        if count:
+            self.counter.add(memoryview(b)[:count])
+        return count
+
+    def write(self, b):
+        self.counter.add(b)
+        return self.stream.write(b)
+
+
+class CountingTextStream(io.TextIOBase):
+    '''A text stream proxy, counting what's read or written.'''
+
+    def __init__(self, stream, counter: Counter) -> None:
+        self.stream = stream
+        self.counter = counter
+
+    def __del__(self):
+        # Unlike other streams, don't close when garbage-collected;
+        # the underlying stream belongs to someone else.
+        pass
+
+    def fileno(self):
+        fd = self.stream.fileno()
+        self.counter.by_fd = True
+        return fd
+
+    def readable(self):
+        return self.stream.readable()
+
+    def writable(self):
+        return self.stream.writable()
+
+    @property
+    def closed(self):
+        return self.stream.closed
+
+    def close(self):
+        self.stream.close()
+
+    def flush(self):
+        self.stream.flush()
+
+    def read(self, size=-1):
+        return self.counter.add(self.stream.read(size))
+
+    def readline(self, size=-1):
+        return self.counter.add(self.stream.readline(size))
+
+    def write(self, s):
+        self.counter.add(s)
+        return self.stream.write(s)
+
+
+def count_items(iterable, counter: Counter):
+    for item in iterable:
+        counter.count += 1
+        counter.calls += 1
+        yield item
+
+
+def wrap(io_type: str, value, counter: Counter):
+    '''Wrap a stage's input or output `value` of type `io_type` to count it.'''
+    if value is None:
+        return None
+    if io_type == 'stream':
+        return CountingStream(value, counter)
+    if io_type == 'tstream':
+        return CountingTextStream(value, counter)
+    if io_type == 'iter':
+        return count_items(value, counter)
+    return value
+
+
+def instrumented(name: Callable[[], str], input_type: str, output_type: str,
+                 thunk):
+    '''
+    Wrap a filter's thunk to measure it when instrumentation is active.
+
+    `name` is called only if needed, to get the stage's name.
+    '''
+    def run(input, output):
+        if not listeners:
+            return thunk(input, output)
+        stage = StageStats(name())
+        counter_in, counter_out = Counter(), Counter()
+        input = wrap(input_type, input, counter_in)
+        output = wrap(output_type, output, counter_out)
+
+        outer_stage = current_stage()
+        local.stage = stage
+        try:
+            result = thunk(input, output)
+        except BaseException:
+            finish(stage, counter_in, counter_out)
+            raise
+        finally:
+            local.stage = outer_stage
+
+        if output_type == 'iter':
+            return finish_after(result, stage, counter_in, counter_out)
+        if output_type == 'bytes':
+            counter_out.add(result)
+        finish(stage, counter_in, counter_out)
+        return result
+
+    return run
+
+
+def finish_after(iterator, stage, counter_in, counter_out):
+    try:
+        yield from count_items(iterator, counter_out)
+    finally:
+        finish(stage, counter_in, counter_out)
+
+
+def finish(stage: StageStats, counter_in: Counter, counter_out: Counter):
+    stage.end = time.perf_counter()
+    if not counter_in.by_fd:
+        stage.bytes_in, stage.chunks_in = counter_in.count, counter_in.calls
+    if not counter_out.by_fd:
+        stage.bytes_out, stage.chunks_out = counter_out.count, counter_out.calls
+    for callback in listeners:
+        callback(stage)
+
+
+class chrome_trace(instrument):
+    '''
+    Context manager: write a Chrome trace-event file for pipelines run within.
+
+    The file at *path* is written when the context exits.  Each stage
+    appears as a span on the timeline of the thread it ran in, with its
+    `StageStats` as the span's details.
+    '''
+
+    def __init__(self, path: str) -> None:
+        super().__init__(self.record)
+        self.path = path
+        self.origin = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def record(self, stage: StageStats) -> None:
+        args = {key: value for key, value in vars(stage).items()
+                if key not in ('name', 'thread', 'start', 'end')
+                and value is not None}
+        event = dict(
+            name=stage.name,
+            ph='X',  # a "complete" event, with a duration
+            ts=(stage.start - self.origin) * 1e6,
+            dur=stage.seconds * 1e6,
+            pid=os.getpid(),
+            tid=stage.thread,
+            args=args,
+        )
+        with self.lock:
+            self.events.append(event)
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        import json
+        super().__exit__(exc_type, exc, traceback)
+        with open(self.path, 'w') as f:
+            json.dump(dict(traceEvents=self.events), f)
@@ -1,6 +1,8 @@
+import functools
 import re
 import _string
 import sys
+from typing import Any, List, NamedTuple, Optional, Tuple, Union
 
 
 def get_field(field_name, args, kwargs):
@@ -19,6 +21,22 @@ def get_field(field_name, args, kwargs):
     return obj
 
 
+def lookup_field(split_field_name, args, kwargs):
+  # Like get_field, but with the field name already split, as by
+  # `compile_words`.
+  first, rest = split_field_name
+
+  obj = args[first] if isinstance(first, int) else kwargs[first]
+
+  for is_attr, i in rest:
+    if is_attr:
+      obj = getattr(obj, i)
+    else:
+      obj = obj[i]
+
+  return obj
+
+
 PAT_SPACE = re.compile(r' +')
 PAT_SPACE_OR_END = re.compile(r' +|\Z')
 
@@ -34,35 +52,66 @@ PAT_MARKUP = re.compile(
       \}''', re.X)
 
 
-def shwords(format_string, *args, **kwargs):
-  '''
-  Split *format_string*, then format using *args* and *kwargs*, producing a list.
-
-  Handy for producing the command line for invoking an external
-  program, conveniently but without the complex gotchas of
-  shell parsing.  For example:
+class Field(NamedTuple):
+  '''One replacement field, like ``{0.foo:>10}``, in a `Words` template.'''
+  field_name: Tuple[Any, Tuple[Tuple[bool, Any], ...]]  # as for lookup_field
+  conversion: Optional[str]
+  format_spec: str
 
-  >>> shwords('rm -rf /tmp/{userdoc}', userdoc='1 .. 2')
-  ['rm', '-rf', '/tmp/1 .. 2']
+  def format(self, args, kwargs) -> str:
+    obj = lookup_field(self.field_name, args, kwargs)
+    if self.conversion == 's':
+      obj = str(obj)
+    return format(obj, self.format_spec)
 
-  The *format_string* is split on spaces.  Each word is then formatted
-  through a minilanguage similar to :meth:`str.format`.  Each word of
-  *format_string* produces exactly one item in the result (unless
-  explicitly instructed otherwise with ``{!@}``), regardless of the
-  contents of the interpolated values.
 
-  The formatting minilanguage is exactly the same as for :meth:`str.format`,
-  except:
+class Splice(NamedTuple):
+  '''A whole-word ``{!@}`` field in a `Words` template.'''
+  field: Field
 
-  * An additional conversion ``!@``, as in ``{!@}``.  This must appear in
-    *format_string* as a whole word.  The argument must be an iterable,
-    and each element of the iterable becomes an element in the result.
 
-  * The conversions ``!r`` and ``!a`` are omitted, because they only make
-    sense within a Python context.
+class Words:
+  '''
+  A format string for `.shwords()`, parsed once for repeated use.
 
-  * No nested interpolation, as in ``{:{}}``.
+  Calling ``compile_words(fmt).format(*args, **kwargs)`` is equivalent
+  to ``shwords(fmt, *args, **kwargs)``.  The work of parsing *fmt* is
+  done only once, by `.compile_words()`; each `format` call just looks
+  up and formats the fields.  Errors in *fmt* itself are raised by
+  `.compile_words()`.
   '''
+
+  format_string: str
+
+  # Each item is one word of the result: a literal string; a `Splice`,
+  # for any number of words; or a list of literal strings and
+  # `Field`s, to be concatenated.
+  words: List[Union[str, Splice, List[Union[str, Field]]]]
+
+  def __init__(self, format_string: str) -> None:
+    self.format_string = format_string
+    self.words = parse_words(format_string)
+
+  def __repr__(self) -> str:
+    return 'compile_words({!r})'.format(self.format_string)
+
+  def format(self, *args, **kwargs) -> List[str]:
+    result = []
+    for word in self.words:
+      if isinstance(word, str):
+        result.append(word)
+      elif isinstance(word, Splice):
+        field = word.field
+        obj = lookup_field(field.field_name, args, kwargs)
+        result.extend(format(item, field.format_spec) for item in obj)
+      else:
+        result.append(''.join(
+          part if isinstance(part, str) else part.format(args, kwargs)
+          for part in word))
+    return result
+
+
+def parse_words(format_string):
   # This implementation is closely based on `string.Formatter` in the
   # stdlib, particularly the `vformat` method; but modified to make
   # the customizations we need.
@@ -71,9 +120,17 @@ def shwords(format_string, *args, **kwargs):
   # instead of using `_string.formatter_parser` we drive it ourselves
   # using the regexes above, some of which are distilled from the
   # C code that implements that function.
+  #
+  # The result is the template for `Words`; see there.
 
   result = []
 
+  def finish_word(word):
+    if len(word) == 1 and isinstance(word[0], str):
+      result.append(word[0])
+    else:
+      result.append(list(word))
+
   fmt = format_string.strip()
   pos = 0
   auto_arg_index = 0
@@ -85,9 +142,10 @@ def shwords(format_string, *args, **kwargs):
     if literal_raw:
       literal = literal_raw.replace('{{', '{').replace('}}', '}')
       words = PAT_SPACE.split(literal)
-      word.append(words[0])
+      if words[0]:
+        word.append(words[0])
       if len(words) > 1:
-        result.append(''.join(word))
+        finish_word(word or [''])
         result.extend(words[1:-1])
         word.clear()
         if words[-1]:
@@ -115,28 +173,75 @@ def shwords(format_string, *args, **kwargs):
                            'numbering')
         auto_arg_index = False
 
-      obj = get_field(field_name, args, kwargs)
+      first, rest = _string.formatter_field_name_split(field_name)
+      field = Field((first, tuple(rest)), conversion, format_spec)
 
-      if conversion is None:
-        word.append(format(obj, format_spec))
-      elif conversion == 's':
-        word.append(format(str(obj), format_spec))
+      if conversion is None or conversion == 's':
+        word.append(field)
       elif conversion == '@':
         match = PAT_SPACE_OR_END.match(fmt, pos)
         if word or (match is None):
           raise ValueError("Invalid use of {!@} not as whole words")
         pos = match.end()
-        result.extend(format(item, format_spec) for item in obj)
+        result.append(Splice(field))
       else:
         raise ValueError("Unknown conversion specifier {0!s}".format(conversion))
 
       match = PAT_MARKUP.match(fmt, pos)
 
   if word:
-    result.append(''.join(word))
+    finish_word(word)
   return result
 
 
+@functools.lru_cache(maxsize=256)
+def compile_words(format_string: str) -> Words:
+  '''
+  Parse *format_string* for `.shwords()`, returning a reusable `Words`.
+
+  Results are cached, so calling `.shwords()` repeatedly with the same
+  format string parses it only once.  Calling this function directly
+  is useful for keeping a parsed format string around explicitly:
+
+  >>> rm = compile_words('rm -rf /tmp/{userdoc}')
+  >>> rm.format(userdoc='1 .. 2')
+  ['rm', '-rf', '/tmp/1 .. 2']
+  '''
+  return Words(format_string)
+
+
+def shwords(format_string, *args, **kwargs):
+  '''
+  Split *format_string*, then format using *args* and *kwargs*, producing a list.
+
+  Handy for producing the command line for invoking an external
+  program, conveniently but without the complex gotchas of
+  shell parsing.  For example:
+
+  >>> shwords('rm -rf /tmp/{userdoc}', userdoc='1 .. 2')
+  ['rm', '-rf', '/tmp/1 .. 2']
+
+  The *format_string* is split on spaces.  Each word is then formatted
+  through a minilanguage similar to :meth:`str.format`.  Each word of
+  *format_string* produces exactly one item in the result (unless
+  explicitly instructed otherwise with ``{!@}``), regardless of the
+  contents of the interpolated values.
+
+  The formatting minilanguage is exactly the same as for :meth:`str.format`,
+  except:
+
+  * An additional conversion ``!@``, as in ``{!@}``.  This must appear in
+    *format_string* as a whole word.  The argument must be an iterable,
+    and each element of the iterable becomes an element in the result.
+
+  * The conversions ``!r`` and ``!a`` are omitted, because they only make
+    sense within a Python context.
+
+  * No nested interpolation, as in ``{:{}}``.
+  '''
+  return compile_words(format_string).format(*args, **kwargs)
+
+
 def caller_namespace(caller_depth=2):
   '''
   Get the names available in an ancestor frame, for emulating f-strings.
@@ -0,0 +1,134 @@
+import asyncio
+import subprocess
+import sys
+import time
+
+import pytest
+
+import pysh
+from pysh import cmd
+
+
+def run(coroutine):
+    # py36: asyncio.run is new in Python 3.7.
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@pysh.filter
+@pysh.input(type='stream')
+@pysh.output(type='stream')
+def upper(input, output):
+    for chunk in cmd.chunks(input):
+        output.write(chunk.upper())
+
+
+@pysh.filter
+@pysh.input(type='iter')
+@pysh.output(type='iter')
+def exclaim(input):
+    for item in input:
+        yield item + b'!'
+
+
+def test_aslurp():
+    assert run(pysh.aslurp(
+        cmd.echo(b'hello') | cmd.run('tr h H')
+    )) == b'Hello'
+
+    # A Python filter in the middle, and a text stream.
+    assert run(pysh.aslurp(
+        cmd.run('seq 3') | upper() | cmd.decode() | cmd.encode()
+        | cmd.run('cat')
+    )) == b'1\n2\n3'
+
+    with pytest.raises(subprocess.CalledProcessError):
+        run(pysh.aslurp(cmd.run('false')))
+
+
+def test_async_iteration():
+    async def collect(pipeline):
+        return [line async for line in pipeline]
+
+    assert run(collect(cmd.run('seq 3') | cmd.splitlines())) \
+        == [b'1', b'2', b'3']
+    assert run(collect(cmd.echo(b'a\nb') | upper() | cmd.splitlines())) \
+        == [b'A', b'B']
+    assert run(collect(cmd.echo(b'a\nb') | cmd.splitlines() | exclaim())) \
+        == [b'a!', b'b!']
+
+
+def test_stop_early():
+    # Closing the iterator early stops the commands upstream.
+    async def first(pipeline):
+        lines = pipeline.__aiter__()
+        async for line in lines:
+            break
+        await lines.aclose()
+        return line
+
+    start = time.monotonic()
+    assert run(first(
+        cmd.run('sh -c {}', 'echo a; sleep 5') | cmd.splitlines())) == b'a'
+    assert time.monotonic() - start < 2
+
+    # A command cut off by SIGPIPE is fine, as with `pysh.slurp`...
+    assert run(pysh.aslurp(cmd.run('yes') | cmd.head(2))) == b'y\ny'
+    # ... but not when nothing stopped reading.
+    with pytest.raises(subprocess.CalledProcessError):
+        run(pysh.aslurp(cmd.run('sh -c {}', 'echo partial; kill -PIPE $$')))
+
+
+def test_concurrent():
+    # Many commands at once, all on one thread: the sleeps overlap.
+    async def main():
+        return await asyncio.gather(*(
+            pysh.aslurp(cmd.run('sh -c {}', 'sleep 0.5; echo {}'.format(i)))
+            for i in range(20)))
+    start = time.monotonic()
+    assert run(main()) == [str(i).encode() for i in range(20)]
+    assert time.monotonic() - start < 2.5
+
+    # Likewise with a stage running in a thread.
+    async def main():
+        return await asyncio.gather(*(
+            pysh.aslurp(cmd.run('sh -c {}', 'sleep 0.5; echo a') | upper())
+            for i in range(5)))
+    start = time.monotonic()
+    assert run(main()) == [b'A'] * 5
+    assert time.monotonic() - start < 1.5
+
+
+def test_timeout(capfd):
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        run(pysh.aslurp(cmd.run('sleep 10') | upper() | cmd.run('cat'),
+                        timeout=0.2))
+    assert time.monotonic() - start < 2
+
+    with pytest.raises(subprocess.TimeoutExpired):
+        run(pysh.ato_stdout(cmd.run('sh -c {}', 'echo a; sleep 10'),
+                            timeout=0.2))
+    assert capfd.readouterr().out == 'a\n'
+
+    # In time, the result is as usual; and each command has its own group.
+    code = 'import os; print(os.getpgid(0) == os.getpid())'
+    pipeline = cmd.run('{} -c {}', sys.executable, code) | cmd.run('cat')
+    if sys.version_info >= (3, 7):
+        assert run(pysh.aslurp(pipeline, timeout=10)) == b'True'
+    assert run(pysh.aslurp(pipeline)) == b'False'
+
+
+def test_cmd():
+    run(pysh.acheck_cmd('true'))
+    with pytest.raises(subprocess.CalledProcessError):
+        run(pysh.acheck_cmd('false'))
+    assert run(pysh.atry_cmd('true')) is True
+    assert run(pysh.atry_cmd('false')) is False
+    assert run(pysh.aslurp_cmd('echo {}', 'a b')) == b'a b'
+    assert run(pysh.atry_slurp_cmd('false')) is None
+    with pytest.raises(subprocess.TimeoutExpired):
+        run(pysh.acheck_cmd('sleep 5', _timeout=0.1))
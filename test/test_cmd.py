@@ -1,12 +1,15 @@
 import io
 import os
 import subprocess
+import threading
+import time
 from typing import List
 
 import pytest
 
 import pysh
 from pysh import cmd
+from pysh.filters import optimize, slurp_filter, stages
 
 
 def test_pipeline():
@@ -24,18 +27,280 @@ def test_pipeline():
     cmd.devnull()()
 
 
+def test_pipeline_concurrent():
+    # The consumer sees the first line while the producer is still running.
+    seen_first = threading.Event()
+
+    @pysh.filter
+    @pysh.output(type='stream')
+    def produce(output):
+        output.write(b'first\n')
+        output.flush()
+        assert seen_first.wait(timeout=10)
+        output.write(b'second\n')
+
+    lines = []
+    for line in produce() | cmd.splitlines():
+        lines.append(line)
+        seen_first.set()
+    assert lines == [b'first', b'second']
+
+
+def test_pipeline_error():
+    @pysh.filter
+    @pysh.output(type='stream')
+    def fail(output):
+        output.write(b'partial\n')
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError, match='boom'):
+        pysh.slurp(fail() | cmd.run('cat'))
+
+
+def test_devnull(monkeypatch):
+    # Next to an external command, no data passes through Python.
+    def fail(*args):
+        assert False
+    monkeypatch.setattr(cmd, 'chunks', fail)
+
+    assert pysh.slurp(cmd.devnull() | cmd.run('wc -c')) == b'0'
+    pysh.slurp(cmd.devnull() | cmd.run('test /dev/stdin -ef /dev/null'))
+
+    (cmd.run('seq 100000') | cmd.devnull())()
+    (cmd.run('test /dev/stdout -ef /dev/null') | cmd.devnull())()
+
+
+def test_slurp_spill():
+    # Within the limit, an ordinary `bytes`.
+    assert pysh.slurp(cmd.echo(b'hello'), spill=100) == b'hello'
+
+    # Beyond it, a memoryview onto a file.
+    data = b'x' * 100000
+    result = pysh.slurp(cmd.echo(data) | cmd.run('cat'), spill=1000)
+    assert isinstance(result, memoryview)
+    assert result.readonly
+    assert result == data
+
+    result = pysh.slurp_cmd('printf {}', 'abc\n\n\n', _spill=2)
+    assert isinstance(result, memoryview)
+    assert result == b'abc'
+    assert pysh.slurp_cmd('printf {}', '\n\n\n', _spill=2) == b''
+
+    with pytest.raises(subprocess.CalledProcessError):
+        pysh.slurp_cmd('sh -c {}', 'seq 1000; exit 1', _spill=10)
+    with pytest.raises(subprocess.TimeoutExpired):
+        pysh.slurp_cmd('sleep 5', _spill=10, _timeout=0.1)
+
+
 def test_echo():
     assert (
         pysh.slurp(cmd.echo(b'hello', b'world'))
     ) == b'hello world'
 
 
+def test_cat(tmp_path, monkeypatch):
+    paths = [tmp_path / 'a', tmp_path / 'b']
+    paths[0].write_bytes(b'hello\n')
+    paths[1].write_bytes(b'x' * 100000)
+    expected = b'hello\n' + b'x' * 100000
+
+    # Output without a file descriptor.
+    buf = io.BytesIO()
+    cmd.cat(*paths).thunk(None, buf)
+    assert buf.getvalue() == expected
+
+    # Neither side with a file descriptor.
+    buf = io.BytesIO()
+    cmd.copy_file(io.BytesIO(expected), buf)
+    assert buf.getvalue() == expected
+    # Input without one; output with one.
+    cmd.write_file(tmp_path / 'c').thunk(io.BytesIO(expected), None)
+    assert (tmp_path / 'c').read_bytes() == expected
+
+    # Output with a file descriptor: copied in the kernel.
+    def fail(*args):
+        assert False
+    monkeypatch.setattr(cmd, 'chunks', fail)
+    assert pysh.slurp(cmd.cat(*paths) | cmd.run('cat')) == expected
+
+
+def test_cat_source(tmp_path):
+    # A command after `cat` of one file reads the file itself.
+    path = tmp_path / 'a'
+    path.write_bytes(b'b\na\n')
+    is_file = 'test -f /dev/stdin && echo file; sort'
+    assert pysh.slurp(cmd.cat(str(path)) | cmd.run('sh -c {}', is_file)) \
+        == b'file\na\nb'
+    assert list(cmd.cat(str(path)) | cmd.splitlines()) == [b'b', b'a']
+    with pytest.raises(FileNotFoundError):
+        pysh.slurp(cmd.cat(str(tmp_path / 'x')) | cmd.run('cat'))
+
+
+def test_read_file(tmp_path, monkeypatch):
+    path = tmp_path / 'a'
+    path.write_bytes(b'b\na\n')
+    assert pysh.slurp(cmd.read_file(str(path))) == b'b\na'
+    assert list(cmd.read_file(path) | cmd.splitlines()) == [b'b', b'a']
+
+    # An external command gets the file itself as stdin.
+    def fail(*args):
+        assert False
+    monkeypatch.setattr(cmd, 'copy_file', fail)
+    is_file = 'test -f /dev/stdin && echo file; sort'
+    assert pysh.slurp(cmd.read_file(path) | cmd.run('sh -c {}', is_file)) \
+        == b'file\na\nb'
+    with pytest.raises(FileNotFoundError):
+        pysh.slurp(cmd.read_file(tmp_path / 'x') | cmd.run('cat'))
+
+
+def test_write_file(tmp_path):
+    path = tmp_path / 'a'
+    (cmd.echo(b'a') | cmd.write_file(path))()
+    assert path.read_bytes() == b'a\n'
+    (cmd.echo(b'b') | cmd.write_file(path, append=True))()
+    assert path.read_bytes() == b'a\nb\n'
+    (cmd.echo(b'c') | cmd.write_file(path))()
+    assert path.read_bytes() == b'c\n'
+
+    # An external command gets the file itself as stdout.
+    is_file = 'test -f /dev/stdout && echo file'
+    (cmd.run('sh -c {}', is_file) | cmd.write_file(path))()
+    assert path.read_bytes() == b'file\n'
+    (cmd.echo(b'x') | cmd.run('sh -c {}', 'cat; ' + is_file)
+     | cmd.write_file(path, append=True))()
+    assert path.read_bytes() == b'file\nx\nfile\n'
+
+
+def test_to_file(tmp_path):
+    path = tmp_path / 'a'
+    is_file = 'test -f /dev/stdout && echo file'
+    pysh.to_file(cmd.run('sh -c {}', is_file), path)
+    assert path.read_bytes() == b'file\n'
+    pysh.to_file(cmd.echo(b'a') | cmd.decode(), path, append=True)
+    assert path.read_bytes() == b'file\na\n'
+    with pytest.raises(subprocess.TimeoutExpired):
+        pysh.to_file(cmd.run('sleep 10'), path, timeout=0.1)
+    with pytest.raises(RuntimeError):
+        pysh.to_file(cmd.echo(b'a') | cmd.splitlines(), path)
+
+
+def test_optimize():
+    pipeline = cmd.echo(b'b\na') | (cmd.run('sort') | cmd.splitlines())
+    planned = optimize(pipeline)
+    assert stages(planned) == stages(pipeline)
+    # Grouped from the left, and kept.
+    assert planned.pipe[1] is stages(pipeline)[-1]
+    assert optimize(pipeline) is planned
+    assert list(pipeline) == [b'a', b'b']
+
+    # A decode and encode that cancel out are dropped.
+    pipeline = (cmd.run('seq 3') | cmd.decode('latin-1')
+                | cmd.encode('ISO-8859-1') | cmd.run('tac'))
+    assert [repr(stage) for stage in stages(optimize(pipeline))] \
+        == ["run('seq 3')", "run('tac')"]
+    assert pysh.slurp(pipeline) == b'3\n2\n1'
+
+    escape = dict(errors='surrogateescape')
+    pipeline = cmd.echo(b'\xff') | cmd.decode(**escape) | cmd.encode(**escape)
+    assert len(stages(optimize(pipeline))) == 1
+    assert pysh.slurp(pipeline) == b'\xff'
+
+    # Not if that would skip an error.
+    pipeline = cmd.echo(b'\xff') | cmd.decode() | cmd.encode()
+    assert len(stages(optimize(pipeline))) == 3
+    with pytest.raises(UnicodeDecodeError):
+        pysh.slurp(pipeline)
+    pipeline = cmd.echo(b'a') | cmd.decode() | cmd.encode('ascii')
+    assert len(stages(optimize(pipeline))) == 3
+
+
+def test_explain(capsys, tmp_path):
+    # Nothing is opened; the file needn't even exist.
+    path = str(tmp_path / 'a')
+    pysh.explain(cmd.cat(path) | cmd.run('sort') | cmd.splitlines())
+    assert capsys.readouterr().out == '''\
+cat({!r})
+  -> file, read directly by the next stage
+run('sort')
+  -> OS pipe, from a background thread
+splitlines()
+'''.format(path)
+
+    pysh.explain(cmd.run('yes') | cmd.decode('latin-1') | cmd.encode('latin-1')
+                 | cmd.run('head') | cmd.write_file('/nonexistent/x'))
+    assert capsys.readouterr().out == '''\
+run('yes')
+  -> OS pipe, from a background thread
+run('head')
+  -> file, written directly by the previous stage
+write_file('/nonexistent/x')
+'''
+
+
 def test_decode():
     world = '\N{WORLD MAP}'.encode()
     assert pysh.slurp(
         cmd.echo(b'hello', world) | cmd.decode() | cmd.encode()
     ) == b'hello ' + world
 
+    # Characters split across reads, and long runs of ASCII, between.
+    data = ('a' * 100000 + '\N{WORLD MAP}\xe9' * 1000 + 'b' * 100000)
+
+    @pysh.filter
+    @pysh.output(type='stream')
+    def dribble(output, data):
+        for i in range(0, len(data), 7):
+            output.write(data[i:i+7])
+            output.flush()
+
+    for encoding in ('utf-8', 'utf-16', 'cp1252', 'latin-1'):
+        encoded = data.encode(encoding, errors='replace')
+        expected = encoded.decode(encoding).encode('utf-8')
+        assert pysh.slurp(
+            cmd.echo(encoded, ln=False) | cmd.decode(encoding) | cmd.encode()
+        ) == expected
+        assert pysh.slurp(
+            dribble(encoded) | cmd.decode(encoding) | cmd.encode()
+        ) == expected
+        assert pysh.slurp(
+            cmd.echo(expected, ln=False) | cmd.decode() | cmd.encode(encoding)
+        ) == encoded
+
+    # Stateful codecs, which are all 7-bit yet not ASCII, across blocks.
+    text = '\u3053\u3093\u306b\u3061\u306f world'
+    data = text + 'a' * 100000 + text * 1000 + 'b' * 100000 + text
+    encoded = data.encode('iso2022_jp')
+    assert pysh.slurp(
+        cmd.echo(encoded, ln=False) | cmd.decode('iso2022_jp') | cmd.encode()
+    ) == data.encode()
+    assert pysh.slurp(
+        cmd.echo(data.encode(), ln=False) | cmd.decode()
+        | cmd.encode('iso2022_jp')
+    ) == encoded
+
+    # Errors.
+    with pytest.raises(UnicodeDecodeError):
+        pysh.slurp(cmd.echo(b'a\xffb') | cmd.decode() | cmd.encode())
+    assert pysh.slurp(
+        cmd.echo(b'a\xffb') | cmd.decode(errors='replace') | cmd.encode()
+    ) == 'a\N{REPLACEMENT CHARACTER}b'.encode()
+    assert pysh.slurp(
+        cmd.echo(b'a\xffb') | cmd.decode(errors='surrogateescape')
+        | cmd.encode(errors='surrogateescape')
+    ) == b'a\xffb'
+    with pytest.raises(UnicodeEncodeError):
+        pysh.slurp(cmd.echo(world) | cmd.decode() | cmd.encode('ascii'))
+    assert pysh.slurp(
+        cmd.echo(world) | cmd.decode() | cmd.encode('ascii', 'replace')
+    ) == b'?'
+
+
+def test_encode_text_input():
+    # Input that isn't a text pipe, as when instrumenting.
+    output = io.BytesIO()
+    cmd.encode('latin-1').thunk(io.StringIO('h\xe9llo\n' * 10000), output)
+    assert output.getvalue() == 'h\xe9llo\n'.encode('latin-1') * 10000
+
 
 def test_splitlines():
     def echo_splitlines(s: str) -> List[str]:
@@ -82,6 +347,138 @@ def test_splitlines_chunks():
     check_resplit(['1\n', '2'])
 
 
+def test_splitlines_delim():
+    assert list(cmd.echo(b'a b\0\0c\n', ln=False)
+                | cmd.splitlines(delim=b'\0')) \
+        == [b'a b', b'', b'c\n']
+    with pytest.raises(ValueError):
+        list(cmd.echo(b'') | cmd.splitlines(delim=b'ab'))
+
+
+def test_splitlines_views():
+    def split_views(s: bytes, delim=b'\n') -> List[bytes]:
+        return [bytes(line) for line in
+                cmd.splitlines(delim=delim, views=True).thunk(
+                    io.BytesIO(s), None)]
+
+    assert split_views(b'1\n\n2') == [b'1', b'', b'2']
+    assert split_views(b'1\n\n2\n') == [b'1', b'', b'2']
+    assert split_views(b'a\0b\0', b'\0') == [b'a', b'b']
+
+    # Lines longer than the buffer.
+    data = b'\n'.join(b'%d' % i * (10000 * i) for i in range(10))
+    assert split_views(data) == data.split(b'\n')
+
+
+def test_splitlines_long():
+    # Many chunks make up one line.
+    data = b'x' * (1 << 20)
+    assert list(cmd.echo(data) | cmd.splitlines()) == [data]
+
+
+def test_joinlines():
+    assert pysh.slurp(
+        cmd.echo(b'b\na') | cmd.splitlines() | cmd.joinlines()
+        | cmd.run('sort')
+    ) == b'a\nb'
+
+    assert pysh.slurp(
+        cmd.echo(b'b\na') | cmd.splitlines() | cmd.joinlines(delim=b'\0')
+        | cmd.run('xargs -0 echo')
+    ) == b'b a'
+
+
+def test_head():
+    assert pysh.slurp(cmd.echo(b'a\nb\nc') | cmd.head(2)) == b'a\nb'
+    assert pysh.slurp(cmd.echo(b'a') | cmd.head(2)) == b'a'
+    assert pysh.slurp(cmd.run('seq 20') | cmd.head()) \
+        == b'\n'.join(b'%d' % i for i in range(1, 11))
+
+    # Upstream stops, broken pipe and all, just as in a shell.
+    assert pysh.slurp(cmd.run('yes') | cmd.head(3)) == b'y\ny\ny'
+    assert pysh.slurp(cmd.run('yes') | cmd.run('head -n 3')) == b'y\ny\ny'
+
+
+def test_stop_early():
+    # When the consumer stops, upstream commands stop too, even busy
+    # ones that aren't writing.
+    start = time.monotonic()
+    for line in cmd.run('sh -c {}', 'echo a; sleep 10') | cmd.splitlines():
+        break
+    assert time.monotonic() - start < 2
+
+    lines = iter(cmd.run('yes') | cmd.splitlines())
+    assert next(lines) == b'y'
+    del lines
+
+    # A stage in Python gets `GeneratorExit`.
+    closed = []
+
+    @pysh.filter
+    @pysh.input(type='iter')
+    @pysh.output(type='iter')
+    def watch(input):
+        try:
+            yield from input
+        finally:
+            closed.append(True)
+
+    for line in cmd.run('yes') | cmd.splitlines() | watch():
+        break
+    assert closed == [True]
+
+
+def test_pipe_iter():
+    @pysh.filter
+    @pysh.input(type='iter')
+    @pysh.output(type='iter')
+    def grep(input, needle):
+        return (line for line in input if needle in line)
+
+    @pysh.filter
+    @pysh.input(type='iter')
+    @pysh.output(type='iter')
+    def upper(input):
+        for line in input:
+            yield line.upper()
+
+    pipeline = (cmd.run('seq 20') | cmd.splitlines()
+                | grep(b'1') | upper() | grep(b'0'))
+    assert list(pipeline) == [b'10']
+    assert pysh.slurp(pipeline | cmd.joinlines()) == b'10'
+
+    # Lazy: stopping early closes every stage.
+    closed = []
+
+    @pysh.filter
+    @pysh.output(type='iter')
+    def count():
+        try:
+            yield from range(1000000)
+        finally:
+            closed.append(True)
+
+    @pysh.filter
+    @pysh.input(type='iter')
+    @pysh.output(type='iter')
+    def passthrough(input):
+        yield from input
+
+    for item in count() | passthrough():
+        break
+    assert closed == [True]
+
+
+def test_pipe_bytes():
+    @pysh.filter
+    @pysh.input(type='bytes')
+    @pysh.output(type='bytes')
+    def reverse(input):
+        return input[::-1]
+
+    assert (cmd.echo(b'abc') | slurp_filter | reverse())() == b'cba'
+
+
 def test_run():
     # (Commits in this repo's history.)
     assert list(cmd.run('git log --abbrev=9 --format={} {}', '%p', '9cdfc6d46')
@@ -110,12 +507,75 @@ def test_run_input_file():
     assert bytes(buf.getbuffer()) == b'abc\nabc\n'
 
 
+def test_run_interleaved():
+    # With neither input nor output backed by a file descriptor, data
+    # flows through the command without waiting for the input to end.
+    num_chunks = 64
+    chunk = b'x' * 65535 + b'\n'
+
+    class Input(io.RawIOBase):
+        def __init__(self):
+            self.count = 0
+
+        def readable(self):
+            return True
+
+        def read1(self, size: int = -1) -> bytes:
+            if self.count == num_chunks:
+                return b''
+            self.count += 1
+            return chunk
+
+    class Output(io.RawIOBase):
+        def __init__(self):
+            self.total = 0
+            self.input_count_at_first_write = None
+
+        def writable(self):
+            return True
+
+        def write(self, b) -> int:
+            if self.input_count_at_first_write is None:
+                self.input_count_at_first_write = input.count
+            self.total += len(b)
+            return len(b)
+
+    input, output = Input(), Output()
+    cmd.run('cat').thunk(input, output)
+    assert output.total == num_chunks * len(chunk)
+    assert output.input_count_at_first_write < num_chunks
+
+
+def test_run_adjacent(monkeypatch):
+    # Adjacent external commands are connected directly to each other;
+    # none of the data passes through Python.
+    def fail(*args):
+        assert False
+    monkeypatch.setattr(cmd, 'chunks', fail)
+    monkeypatch.setattr(cmd, 'pump', fail)
+
+    readfd, writefd = os.pipe()
+    with os.fdopen(writefd, 'wb') as f:
+        (cmd.run('seq 100000') | cmd.run('grep -c 7')).thunk(None, f)
+    with os.fdopen(readfd, 'rb') as f:
+        assert f.read() == b'40951\n'
+
+
 def test_run_check():
     with pytest.raises(subprocess.CalledProcessError):
         pysh.slurp(cmd.run('false'))
 
     assert pysh.slurp(cmd.run('false', _check=False)) == b''
 
+    # Killed by SIGPIPE, though nothing stopped reading: still a failure.
+    script = 'echo partial; kill -PIPE $$'
+    with pytest.raises(subprocess.CalledProcessError):
+        pysh.to_stdout(cmd.run('sh -c {}', script))
+    with pytest.raises(subprocess.CalledProcessError):
+        pysh.slurp(cmd.run('sh -c {}', script))
+    with pytest.raises(subprocess.CalledProcessError):
+        pysh.slurp(cmd.run('sh -c {}', script) | cmd.run('cat'))
+
 
 def test_run_stderr(capfd):
     # On `capfd`, see pytest docs:
@@ -140,3 +600,236 @@ def test_run_stderr(capfd):
         | cmd.splitlines()
     ) == [b'a', b'ERR', b'b']
     assert capfd.readouterr() == ('', '')
+
+
+def test_map_cmd():
+    assert list(pysh.map_cmd('echo {} {sep}', ['a', 'b c', 'd'], sep='.')) \
+        == [b'a .', b'b c .', b'd .']
+
+    # Results in order, even when later ones finish first.
+    assert list(pysh.map_cmd('sh -c {}', ['sleep 0.2; echo 1', 'echo 2'],
+                             _jobs=2)) \
+        == [b'1', b'2']
+    assert list(pysh.map_cmd('sh -c {}', ['sleep 0.2; echo 1', 'echo 2'],
+                             _jobs=2, _ordered=False)) \
+        == [('echo 2', b'2'), ('sleep 0.2; echo 1', b'1')]
+
+    assert list(pysh.try_map_cmd('test {} = x', ['x', 'y', 'x'])) \
+        == [b'', None, b'']
+
+
+def test_map_cmd_failure():
+    # The failure stops everything else promptly.
+    start = time.monotonic()
+    with pytest.raises(subprocess.CalledProcessError):
+        pysh.check_map_cmd('sh -c {}', ['sleep 5', 'false'] + ['sleep 5'] * 10,
+                           _jobs=2)
+    assert time.monotonic() - start < 2
+
+
+def test_cached(tmp_path, monkeypatch):
+    counter = tmp_path / 'count'
+    script = 'echo x >> {}; wc -l < {}'.format(counter, counter)
+    watched = tmp_path / 'watched'
+    slurp = pysh.cached(maxsize=2, env=['PYSH_TEST'], paths=[str(watched)])
+
+    assert slurp('sh -c {}', script) == b'1'
+    assert slurp('sh -c {}', script) == b'1'
+    assert (slurp.hits, slurp.misses) == (1, 1)
+
+    # Keyed on cwd, and the chosen environment variables.
+    assert slurp('sh -c {}', script, _cwd='/') == b'2'
+    monkeypatch.setenv('PYSH_TEST', 'a')
+    assert slurp('sh -c {}', script) == b'3'
+    # The least recently used went.
+    assert slurp('sh -c {}', script, _cwd='/') == b'4'
+
+    # A change to one of the paths invalidates.
+    monkeypatch.delenv('PYSH_TEST')
+    assert slurp('sh -c {}', script) == b'5'
+    watched.write_bytes(b'')
+    assert slurp('sh -c {}', script) == b'6'
+    assert (slurp.hits, slurp.misses) == (1, 6)
+
+    # As does the TTL.
+    slurp = pysh.cached(pysh.try_slurp_cmd, ttl=0.05)
+    assert slurp('false') is None
+    assert slurp('sh -c {}', script) == b'7'
+    assert slurp('sh -c {}', script) == b'7'
+    time.sleep(0.1)
+    assert slurp('sh -c {}', script) == b'8'
+    assert slurp('false') is None
+    assert (slurp.hits, slurp.misses) == (1, 4)
+
+    slurp.clear()
+    assert slurp('sh -c {}', script) == b'9'
+
+    # Keyed on options that change the result, like `_spill`.
+    assert isinstance(slurp('sh -c {}', script, _spill=0), memoryview)
+    assert isinstance(slurp('sh -c {}', script), bytes)
+    assert bytes(slurp('sh -c {}', script, _spill=0)) == b'10'
+
+
+def test_coproc():
+    # `cat` echoes each request, however it's framed.
+    for framing in ('line', 'nul', 'length'):
+        with pysh.coproc('cat', _framing=framing) as echo:
+            assert echo.request(b'a b') == b'a b'
+            assert echo.request(b'') == b''
+            assert echo.request(b'xyz' * 10000) == b'xyz' * 10000
+            assert len(echo.procs) == 1
+    with pysh.coproc('cat', _framing='length') as echo:
+        assert echo.request(b'x\0y\nz') == b'x\0y\nz'
+
+    with pysh.coproc('cat', _framing=lambda f: f.read(2)) as echo:
+        assert echo.request(b'ab') == b'ab'
+    with pytest.raises(ValueError):
+        echo.request(b'ab')
+
+
+def test_coproc_jobs():
+    script = 'while read x; do sleep 0.2; echo "$$ $x"; done'
+    with pysh.coproc('sh -c {}', script, _jobs=2) as slow:
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda i=i: results.append(slow.request(b'%d' % i)))
+            for i in range(4)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert time.monotonic() - start < 0.6
+    pids = {result.split()[0] for result in results}
+    assert len(pids) == 2
+    assert sorted(result.split()[1] for result in results) \
+        == [b'0', b'1', b'2', b'3']
+
+
+def test_coproc_exit():
+    with pysh.coproc('sh -c {}', 'read x; echo "$x"; exit 3') as once:
+        assert once.request(b'a') == b'a'
+        with pytest.raises(subprocess.CalledProcessError) as info:
+            once.request(b'b')
+        assert info.value.returncode == 3
+        # Then it starts afresh.
+        assert once.request(b'c') == b'c'
+
+    with pysh.coproc('sh -c {}', 'read x; echo "$x"') as once:
+        assert once.request(b'a') == b'a'
+        with pytest.raises(EOFError):
+            once.request(b'b')
+
+
+def test_xargs():
+    words = [b'%d' % i for i in range(10)]
+
+    def xargs(*args, **kwargs):
+        return pysh.slurp(
+            cmd.echo(b'\n'.join(words)) | cmd.splitlines()
+            | cmd.xargs(*args, **kwargs))
+
+    assert xargs('echo {}', 'x') == b'x ' + b' '.join(words)
+    assert xargs('echo', max_args=4) == b'0 1 2 3\n4 5 6 7\n8 9'
+    assert xargs('sh -c {} sh', 'sleep 0.$1; echo "$@"',
+                 max_args=3, jobs=4) \
+        == b'0 1 2\n3 4 5\n6 7 8\n9'
+    # Fastest first.
+    assert xargs('sh -c {} sh', 'sleep 0.$((9 - $1)); echo "$@"',
+                 max_args=3, jobs=4, ordered=False).split(b'\n') \
+        == [b'9', b'6 7 8', b'3 4 5', b'0 1 2']
+
+    with pytest.raises(subprocess.CalledProcessError):
+        xargs('false')
+    assert xargs('false', _check=False) == b''
+
+
+def test_xargs_arg_max():
+    # Many more arguments than fit in one command line.
+    count = 300000
+    lines = list(
+        cmd.run('seq {}', str(count)) | cmd.splitlines()
+        | cmd.xargs('sh -c {} sh', 'echo $#', jobs=2)
+        | cmd.splitlines())
+    assert 1 < len(lines) < 50
+    assert sum(int(line) for line in lines) == count
+
+
+def test_tee(tmp_path):
+    data = b''.join(b'%d\n' % i for i in range(100000))
+    path = str(tmp_path / 'copy')
+    buf = io.BytesIO()
+    chunks = []
+    seen = []
+
+    @pysh.filter
+    @pysh.input(type='stream')
+    def count(input):
+        seen.append(len(input.read()))
+
+    assert pysh.slurp(
+        cmd.echo(data, ln=False)
+        | cmd.tee(path, buf, chunks.append, count(),
+                  cmd.run('head -1') | cmd.run('cat'))
+        | cmd.run('wc -c')
+    ) == b'%d' % len(data)
+    assert open(path, 'rb').read() == data
+    assert buf.getvalue() == data
+    assert b''.join(chunks) == data
+    assert seen == [len(data)]
+
+    # A sink pipeline is optimized, like any other.
+    stats = []
+    with pysh.trace.instrument(stats.append):
+        (cmd.echo(data, ln=False)
+         | cmd.tee(cmd.decode('latin-1') | cmd.encode('latin-1')
+                   | cmd.write_file(path)))()
+    assert open(path, 'rb').read() == data
+    assert not [stage for stage in stats
+                if stage.name.startswith(('decode', 'encode'))]
+
+    # At the end of a pipeline, too.
+    buf = io.BytesIO()
+    (cmd.echo(b'hello') | cmd.tee(buf))()
+    assert buf.getvalue() == b'hello\n'
+
+    # Failures come out at the end.
+    def fail(chunk):
+        raise ValueError()
+    with pytest.raises(ValueError):
+        (cmd.echo(data) | cmd.tee(fail, buf))()
+    with pytest.raises(subprocess.CalledProcessError):
+        (cmd.echo(data) | cmd.tee(cmd.run('false')))()
+
+
+def test_tee_open_failure(tmp_path):
+    # The sinks started before the failure are finished, not leaked.
+    done = tmp_path / 'done'
+    sink = cmd.run('sh -c {}', 'cat >/dev/null; echo >{}'.format(done))
+    with pytest.raises(FileNotFoundError):
+        (cmd.echo(b'a') | cmd.tee(sink, str(tmp_path / 'x' / 'y')))()
+    assert done.exists()
+    assert not [thread for thread in threading.enumerate()
+                if isinstance(thread, cmd.TeeBranch)]
+
+
+def test_tee_concurrent():
+    # One sink can get ahead of a slow one, but only so far.
+    release = threading.Event()
+    fast = []
+
+    def slow(chunk):
+        release.wait(timeout=10)
+
+    def done():
+        (cmd.run('seq 1000000') | cmd.tee(fast.append, slow))()
+
+    thread = threading.Thread(target=done, daemon=True)
+    thread.start()
+    time.sleep(0.2)
+    assert 0 < len(fast) < 64
+    release.set()
+    thread.join()
+    assert len(b''.join(fast)) == len(b''.join(
+        b'%d\n' % i for i in range(1, 1000001)))
@@ -0,0 +1,108 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import pysh
+from pysh import cmd, deadline, launcher
+
+
+@pytest.fixture(autouse=True)
+def short_grace(monkeypatch):
+    monkeypatch.setattr(deadline, 'GRACE_PERIOD', 0.3)
+
+
+def alive(pid: int) -> bool:
+    '''Whether `pid` is running; a zombie doesn't count.'''
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            state = f.read().rpartition(')')[2].split()[0]
+    except FileNotFoundError:
+        return False
+    return state not in ('Z', 'X')
+
+
+def test_timeout():
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        pysh.slurp(cmd.run('sleep 10') | cmd.run('cat'), timeout=0.2)
+    assert time.monotonic() - start < 2
+
+    # Through a stage in Python, too.
+    @pysh.filter
+    @pysh.input(type='stream')
+    @pysh.output(type='stream')
+    def copy(input, output):
+        for chunk in iter(lambda: input.read1(4096), b''):
+            output.write(chunk)
+
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        pysh.slurp(cmd.run('sleep 10') | copy() | cmd.run('cat'),
+                   timeout=0.2)
+    assert time.monotonic() - start < 2
+
+
+def test_timeout_to_stdout(capfd):
+    with pytest.raises(subprocess.TimeoutExpired):
+        pysh.to_stdout(cmd.run('sh -c {}', 'echo a; sleep 10'), timeout=0.2)
+    assert capfd.readouterr().out == 'a\n'
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc'), reason='needs /proc')
+def test_timeout_descendants(tmp_path):
+    # The command's own children are stopped too.
+    pidfile = str(tmp_path / 'pid')
+    with pytest.raises(subprocess.TimeoutExpired):
+        pysh.slurp(cmd.run('sh -c {}', 'sleep 10 & echo $! >{}; wait'
+                           .format(pidfile)),
+                   timeout=0.2)
+    with open(pidfile) as f:
+        pid = int(f.read())
+    for _ in range(100):
+        if not alive(pid):
+            break
+        time.sleep(0.01)
+    assert not alive(pid)
+
+
+def test_timeout_kill():
+    # A command ignoring SIGTERM gets SIGKILL, after the grace period.
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        pysh.slurp(cmd.run('sh -c {}', 'trap "" TERM; sleep 10'),
+                   timeout=0.2)
+    assert 0.5 <= time.monotonic() - start < 2
+
+
+def test_timeout_xargs():
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        pysh.slurp(cmd.echo(b'10\n10') | cmd.splitlines()
+                   | cmd.xargs('sleep', max_args=1, jobs=2), timeout=0.2)
+    assert time.monotonic() - start < 2
+
+
+def test_timeout_met():
+    # In time, the result is as usual; and each command has its own group.
+    code = 'import os; print(os.getpgid(0) == os.getpid())'
+    pipeline = cmd.run('{} -c {}', sys.executable, code) | cmd.run('cat')
+    assert pysh.slurp(pipeline, timeout=10) == b'True'
+    assert pysh.slurp(pipeline) == b'False'
+    assert deadline.current() is None
+
+    with pytest.raises(subprocess.CalledProcessError):
+        pysh.slurp(cmd.run('false'), timeout=10)
+
+
+def test_timeout_launcher():
+    launcher.start()
+    try:
+        start = time.monotonic()
+        with pytest.raises(subprocess.TimeoutExpired):
+            pysh.slurp(cmd.run('sh -c {}', 'sleep 10; echo'), timeout=0.2)
+        assert time.monotonic() - start < 2
+    finally:
+        launcher.stop()
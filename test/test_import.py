@@ -0,0 +1,74 @@
+import os
+import subprocess
+import sys
+
+# The budget for `python -X importtime -c 'import pysh'`, in
+# microseconds.  It takes well under 1ms, with compiled bytecode; the
+# budget leaves room for slow machines, but not for an eager import
+# of the machinery for running commands, which took ~100ms.
+IMPORT_BUDGET_US = 10000
+
+
+def python(args, tmp_path) -> subprocess.CompletedProcess:
+    '''Run Python with `args`, using cached bytecode, capturing output.'''
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPYCACHEPREFIX'] = str(tmp_path / 'pycache')
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [repo] + env.get('PYTHONPATH', '').split(os.pathsep))
+    return subprocess.run(
+        [sys.executable] + args, env=env, check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+
+
+def import_time_us(code: str, tmp_path) -> int:
+    '''Time taken by the imports done by `code`, as by `-X importtime`.'''
+    python(['-c', code], tmp_path)  # Compile the bytecode.
+    times = []
+    for _ in range(3):
+        report = python(['-X', 'importtime', '-c', code], tmp_path).stderr
+        # Sum the top-level imports, from the first of pysh on.
+        total = 0
+        started = False
+        for line in report.splitlines():
+            if not line.startswith('import time:') or '[us]' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if name.startswith('  '):
+                continue  # Nested; already counted.
+            started = started or name.strip().startswith('pysh')
+            if started:
+                total += int(cumulative)
+        times.append(total)
+    return min(times)
+
+
+def loaded_modules(code: str, tmp_path) -> set:
+    code += '; import sys; print(" ".join(sys.modules))'
+    return set(python(['-c', code], tmp_path).stdout.split())
+
+
+def test_import_budget(tmp_path):
+    assert import_time_us('import pysh', tmp_path) < IMPORT_BUDGET_US
+
+
+def test_import_lazy(tmp_path):
+    modules = loaded_modules('import pysh', tmp_path)
+    assert [name for name in modules if name.startswith('pysh')] == ['pysh']
+
+    modules = loaded_modules('from pysh import shwords', tmp_path)
+    assert 'pysh.words' in modules
+    for name in ('pysh.filters', 'pysh.subprocess', 'subprocess', 'asyncio',
+                 'threading'):
+        assert name not in modules
+
+
+def test_attributes():
+    import pysh
+    assert pysh.shwords('echo {}', 'a') == ['echo', 'a']
+    assert pysh.cmd.run is not None
+    assert 'slurp_cmd' in dir(pysh)
+    assert set(pysh.__all__) <= set(dir(pysh))
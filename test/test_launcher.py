@@ -0,0 +1,84 @@
+import os
+import signal
+import subprocess
+import time
+
+import pytest
+
+import pysh
+from pysh import cmd, launcher, spawn, trace
+
+
+@pytest.fixture
+def started():
+    yield launcher.start()
+    launcher.stop()
+
+
+def test_launcher(started, tmp_path, monkeypatch):
+    before = spawn.counts.copy()
+    assert pysh.slurp_cmd('echo {}', 'hi') == b'hi'
+    assert spawn.counts - before == {'launcher': 1}
+
+    # The command sees our cwd and environment as they are now.
+    monkeypatch.setenv('PYSH_TEST', 'value')
+    assert pysh.slurp_cmd('sh -c {}', 'echo $PYSH_TEST') == b'value'
+    monkeypatch.chdir(str(tmp_path))
+    assert pysh.slurp_cmd('pwd') == str(tmp_path.resolve()).encode()
+    assert pysh.slurp_cmd('pwd', _cwd='/') == b'/'
+
+    # Pipelines, with fds or pipes to Python.
+    assert pysh.slurp(cmd.run('seq 3') | cmd.run('tac')) == b'3\n2\n1'
+    assert pysh.slurp(cmd.echo(b'abc') | cmd.run('tr a-z A-Z')) == b'ABC'
+    assert list(pysh.map_cmd('echo {}', ['a', 'b'])) == [b'a', b'b']
+
+
+def test_launcher_errors(started, capfd):
+    with pytest.raises(FileNotFoundError):
+        pysh.check_cmd('pysh-nonexistent-command')
+    with pytest.raises(subprocess.CalledProcessError) as info:
+        pysh.slurp_cmd('sh -c {}', 'echo out; exit 3')
+    assert info.value.output == b'out\n'
+    with pytest.raises(subprocess.TimeoutExpired):
+        pysh.slurp_cmd('sleep 10', _timeout=0.1)
+
+    pysh.check_cmd('sh -c {}', 'echo err >&2', _stderr=pysh.STDOUT)
+    assert capfd.readouterr() == ('err\n', '')
+
+
+def test_launcher_trace(started):
+    stages = []
+    with trace.instrument(stages.append):
+        pysh.slurp(cmd.run('true'))
+    stage, = stages
+    assert stage.spawn_method == 'launcher'
+    assert stage.returncode == 0
+    assert stage.max_rss_kib > 0
+
+
+def test_launcher_exited(started):
+    os.kill(started.process.pid, signal.SIGKILL)
+    started.process.wait()
+    # Commands are started directly instead.
+    assert pysh.slurp_cmd('echo {}', 'hi') == b'hi'
+    assert pysh.slurp_cmd('echo {}', 'hi') == b'hi'
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc'), reason='needs /proc')
+def test_launcher_signal(started, monkeypatch):
+    proc = started.launch(['sleep', '10'])
+    proc.kill()
+    assert proc.wait() == -signal.SIGKILL
+
+    # Once the command has exited, and the launcher has reaped it, its
+    # pid may be reused; it's not signalled.
+    proc = started.launch(['true'])
+    while os.path.exists('/proc/{}'.format(proc.pid)):
+        time.sleep(0.01)
+    killed = []
+    monkeypatch.setattr(os, 'kill', lambda *args: killed.append(args))
+    proc.terminate()
+    proc.kill()
+    assert proc.wait() == 0
+    assert killed == []
+    proc.kill()  # And after we've heard, it's a no-op.
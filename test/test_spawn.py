@@ -0,0 +1,94 @@
+import os
+import subprocess
+
+import pytest
+
+import pysh
+from pysh import cmd, spawn, trace
+
+needs_posix_spawn = pytest.mark.skipif(
+    not spawn.supported(), reason='no posix_spawn path in subprocess')
+
+
+def spawned_with(func):
+    before = spawn.counts.copy()
+    result = func()
+    return result, spawn.counts - before
+
+
+@needs_posix_spawn
+def test_posix_spawn(monkeypatch):
+    monkeypatch.setattr(spawn, 'popen_method', lambda: 'fork')
+    assert spawned_with(lambda: pysh.check_cmd('true')) \
+        == (None, {'posix_spawn': 1})
+    assert spawned_with(lambda: pysh.slurp_cmd('echo {}', 'hi')) \
+        == (b'hi', {'posix_spawn': 1})
+    pipeline = cmd.run('echo a') | cmd.run('cat')
+    assert spawned_with(lambda: pysh.slurp(pipeline)) \
+        == (b'a', {'posix_spawn': 2})
+
+
+@needs_posix_spawn
+def test_posix_spawn_cwd(tmp_path, monkeypatch):
+    monkeypatch.setattr(spawn, 'popen_method', lambda: 'fork')
+    path = str(tmp_path.resolve())
+    with open(os.path.join(path, 'script'), 'w') as f:
+        f.write('#!/bin/sh\necho "$0" "$@"\n')
+    os.chmod(os.path.join(path, 'script'), 0o755)
+
+    assert spawned_with(lambda: pysh.slurp_cmd('pwd', _cwd=path)) \
+        == (path.encode(), {'posix_spawn': 1})
+    # A relative path to the command is relative to the cwd.
+    assert pysh.slurp_cmd('./script {}', 'a b', _cwd=path) == b'./script a b'
+
+    # Errors as usual.
+    with pytest.raises(FileNotFoundError):
+        pysh.check_cmd('pwd', _cwd=os.path.join(path, 'nonexistent'))
+    with pytest.raises(FileNotFoundError):
+        pysh.check_cmd('./nonexistent', _cwd=path)
+
+
+def test_errors():
+    with pytest.raises(FileNotFoundError):
+        pysh.check_cmd('pysh-nonexistent-command')
+    with pytest.raises(subprocess.CalledProcessError) as info:
+        pysh.slurp_cmd('sh -c {}', 'echo out; exit 3')
+    assert info.value.cmd == ['sh', '-c', 'echo out; exit 3']
+    assert info.value.output == b'out\n'
+    with pytest.raises(subprocess.TimeoutExpired):
+        pysh.slurp_cmd('sleep 10', _timeout=0.1)
+
+
+def test_std_fds(capfd):
+    # Redirections to the standard file descriptors work the same.
+    pysh.check_cmd('sh -c {}', 'echo out; echo err >&2',
+                   _stdout=2, _stderr=1)
+    assert capfd.readouterr() == ('err\n', 'out\n')
+    pysh.check_cmd('sh -c {}', 'echo out; echo err >&2',
+                   _stderr=pysh.STDOUT)
+    assert capfd.readouterr() == ('out\nerr\n', '')
+
+
+def test_popen_fallback(monkeypatch):
+    monkeypatch.setattr(spawn, 'enabled', False)
+    assert spawned_with(lambda: pysh.slurp_cmd('echo {}', 'hi')) \
+        == (b'hi', {spawn.popen_method(): 1})
+
+
+def test_popen_vfork(monkeypatch):
+    # Where Popen uses vfork, it's used as is.
+    monkeypatch.setattr(spawn, 'popen_method', lambda: 'vfork')
+    assert spawned_with(lambda: pysh.slurp_cmd('echo {}', 'hi')) \
+        == (b'hi', {'vfork': 1})
+    assert spawned_with(lambda: pysh.slurp_cmd('pwd', _cwd='/')) \
+        == (b'/', {'vfork': 1})
+
+
+def test_trace():
+    stages = []
+    with trace.instrument(stages.append):
+        pysh.slurp(cmd.run('true'))
+    expected = ('posix_spawn'
+                if spawn.supported() and spawn.popen_method() == 'fork'
+                else spawn.popen_method())
+    assert [stage.spawn_method for stage in stages] == [expected]
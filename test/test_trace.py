@@ -0,0 +1,47 @@
+import json
+
+import pysh
+from pysh import cmd, trace
+
+
+def test_instrument():
+    stages = []
+    with trace.instrument(stages.append):
+        assert pysh.slurp(
+            cmd.run('seq 1000') | cmd.splitlines() | cmd.joinlines()
+            | cmd.run('wc -l')
+        ) == b'1000'
+    # Not after the context exits.
+    pysh.slurp(cmd.echo(b'hello'))
+
+    by_name = {stage.name: stage for stage in stages}
+    assert sorted(by_name) == [
+        'joinlines()', "run('seq 1000')", "run('wc -l')", 'splitlines()']
+
+    seq = by_name["run('seq 1000')"]
+    assert seq.argv == ['seq', '1000']
+    assert seq.returncode == 0
+    assert seq.user_time >= 0 and seq.max_rss_kib > 0
+    # Its output went straight to a pipe, unseen by Python.
+    assert seq.bytes_out is None
+
+    split = by_name['splitlines()']
+    assert split.bytes_in == len(b''.join(b'%d\n' % i for i in range(1, 1001)))
+    assert split.bytes_out == 1000  # items
+    assert split.pid is None
+    assert by_name['joinlines()'].bytes_out == split.bytes_in
+
+    for stage in stages:
+        assert stage.seconds >= 0
+
+
+def test_chrome_trace(tmp_path):
+    path = str(tmp_path / 'trace.json')
+    with trace.chrome_trace(path):
+        pysh.slurp(cmd.echo(b'hello') | cmd.run('cat'))
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    assert sorted(event['name'] for event in events) \
+        == ["echo(b'hello')", "run('cat')"]
+    for event in events:
+        assert event['ph'] == 'X' and event['dur'] >= 0
@@ -2,7 +2,7 @@ import sys
 
 import pytest
 
-from pysh import shwords, shwords_f
+from pysh import compile_words, shwords, shwords_f
 
 
 def test_conversions():
@@ -78,3 +78,20 @@ def test_locals():
     assert shwords_f('touch {l!@}') \
       == ['touch', 'a', 'b']
   inner3()
+
+
+def test_compile_words():
+  words = compile_words('tar -C {outdir} -xzf {!@} {{x}}')
+  assert words.format(['a.tgz', 'b c.tgz'], outdir='/tmp/o p') \
+    == ['tar', '-C', '/tmp/o p', '-xzf', 'a.tgz', 'b c.tgz', '{x}']
+  assert words.format([], outdir='.') \
+    == ['tar', '-C', '.', '-xzf', '{x}']
+
+  # Cached, so repeated `shwords` calls parse only once.
+  assert compile_words('tar -C {outdir}') is compile_words('tar -C {outdir}')
+
+  # Errors in the format string itself come out at compile time.
+  with pytest.raises(ValueError):
+    compile_words('a b{!@}')
+  with pytest.raises(ValueError):
+    compile_words('{} {0}')